@@ -1,9 +1,11 @@
 from passlib.context import CryptContext
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 from jose import jwt, JWTError
 from datetime import datetime, timedelta
 from fastapi import HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer
-from models import get_user
+from models import get_user_credentials, get_user_cached
 from jose import JWTError, jwt
 from fastapi import WebSocket, WebSocketException
 from starlette.status import WS_1008_POLICY_VIOLATION
@@ -15,17 +17,45 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# bcrypt занимает ~100-300 мс CPU — выносим его из event loop в пул потоков
+# (bcrypt отпускает GIL), чтобы вход пачки пользователей не стопорил WebSocket'ы.
+PASSWORD_HASH_WORKERS = 4
+PASSWORD_HASH_QUEUE_LIMIT = 256  # сверх этого отвечаем 503, а не копим очередь
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_password_queue_depth = 0
+
+def password_queue_depth() -> int:
+    # Задачи хеширования, ожидающие или выполняющиеся в пуле
+    return _password_queue_depth
+
+async def _run_password_job(func, *args):
+    global _password_queue_depth
+    if _password_queue_depth >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(status_code=503, detail="Сервер перегружен, попробуйте позже")
+    _password_queue_depth += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_queue_depth -= 1
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+async def get_password_hash_async(password):
+    return await _run_password_job(get_password_hash, password)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_password_job(verify_password, plain_password, hashed_password)
+
 async def authenticate_user(username: str, password: str):
-    user = await get_user(username)
+    user = await get_user_credentials(username)
     if not user:
         return None
-    if not verify_password(password, user["hashed_password"]):
+    if not await verify_password_async(password, user["hashed_password"]):
         return None
     return user
 
@@ -45,7 +75,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
 
-    user = await get_user(username)
+    user = await get_user_cached(username)
     if user is None:
         raise credentials_exception
     return user
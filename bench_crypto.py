@@ -0,0 +1,41 @@
+# Замер пакетного шифрования/расшифровки сообщений, без базы:
+#   python bench_crypto.py [длина сообщения]
+# Печатает сообщений в секунду для 1k/10k/100k и время страницы истории —
+# по нему подбираются пороги выноса в поток в crypto.py.
+import sys
+import time
+from crypto import (
+    BATCH_THREAD_BYTES, BATCH_THREAD_THRESHOLD,
+    decrypt_message, decrypt_many, encrypt_many,
+)
+
+COUNTS = (1_000, 10_000, 100_000)
+PAGE = 200  # MESSAGES_PAGE_MAX в main.py
+
+def bench(func, items) -> float:
+    started = time.perf_counter()
+    func(items)
+    return time.perf_counter() - started
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    text = ("привет " * length)[:length]
+    print(f"длина сообщения {length} символов; пороги: {BATCH_THREAD_THRESHOLD} шт. или {BATCH_THREAD_BYTES} байт")
+
+    for count in COUNTS:
+        plain = [text] * count
+        encrypted = encrypt_many(plain)
+        enc = bench(encrypt_many, plain)
+        dec = bench(decrypt_many, encrypted)
+        one = bench(lambda items: [decrypt_message(item) for item in items], encrypted)
+        print(
+            f"{count:>7}: encrypt_many {count / enc:>9.0f}/с  decrypt_many {count / dec:>9.0f}/с  "
+            f"decrypt_message {count / one:>9.0f}/с"
+        )
+
+    page = encrypt_many([text] * PAGE)
+    dec = min(bench(decrypt_many, page) for _ in range(20))
+    print(f"страница из {PAGE}: {dec * 1000:.2f} мс, {sum(map(len, page))} байт шифртекста")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Рассылка в большую группу, без базы:
+#   python bench_fanout.py [участников]
+# Регистрирует фейковые подключения (по умолчанию 5000) и замеряет
+# push_group_message: время самого вызова (сериализация и постановка в
+# очереди) и время, за которое писатели доставили сообщение всем сокетам.
+import asyncio
+import sys
+import time
+from broker import push_group_message
+from connections import add_connection
+
+ROUNDS = 20
+
+class CountingSocket:
+    def __init__(self, delivered: dict):
+        self.delivered = delivered
+
+    async def send_text(self, text):
+        self.delivered["count"] += 1
+
+    async def close(self, code=1000):
+        pass
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+async def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    members = [f"member{i}" for i in range(size)]
+    delivered = {"count": 0}
+    connections = [add_connection(username, CountingSocket(delivered)) for username in members]
+    payload = {"type": "new_group_message", "data": {"group_id": "g", "sender": members[0], "content": "привет " * 20}}
+
+    call_ms, delivery_ms = [], []
+    for _ in range(ROUNDS):
+        delivered["count"] = 0
+        started = time.perf_counter()
+        await push_group_message(members, members[0], payload)
+        call_ms.append((time.perf_counter() - started) * 1000)
+        while delivered["count"] < size - 1:
+            await asyncio.sleep(0)
+        delivery_ms.append((time.perf_counter() - started) * 1000)
+
+    for conn in connections:
+        conn.close()
+    print(f"группа из {size}, {ROUNDS} рассылок")
+    print(f"  push_group_message: p50 {percentile(call_ms, 0.5):.2f} мс, max {max(call_ms):.2f} мс")
+    print(f"  доставка всем:      p50 {percentile(delivery_ms, 0.5):.2f} мс, max {max(delivery_ms):.2f} мс")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+# Задержка доставки WebSocket-сообщений во время волны входов, без базы:
+#   python bench_logins.py [входов в секунду] [секунд]
+# Входы проверяют bcrypt-пароль с заданной частотой (по умолчанию 100/с), а
+# параллельно каждые 10 мс через брокер отправляется сообщение на фейковый
+# сокет и замеряется, через сколько оно дошло. Два прогона: bcrypt прямо в
+# event loop (как было раньше) и через пул verify_password_async.
+import asyncio
+import sys
+import time
+from fastapi import HTTPException
+from auth import get_password_hash, verify_password, verify_password_async
+from broker import push_personal_message
+from connections import add_connection
+
+PROBE_INTERVAL = 0.01
+
+class TimingSocket:
+    def __init__(self):
+        self.latencies = []
+
+    async def send_text(self, text):
+        sent_at = float(text[len('{"sent": '):-1])
+        self.latencies.append(time.perf_counter() - sent_at)
+
+    async def close(self, code=1000):
+        pass
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+async def run(mode: str, rate: int, seconds: float, hashed: str):
+    socket = TimingSocket()
+    conn = add_connection(f"probe-{mode}", socket)
+    stats = {"ok": 0, "rejected": 0}
+
+    async def login():
+        try:
+            if mode == "pool":
+                await verify_password_async("password", hashed)
+            else:
+                verify_password("password", hashed)
+            stats["ok"] += 1
+        except HTTPException:
+            stats["rejected"] += 1  # 503: очередь пула переполнена
+
+    async def logins():
+        tasks = []
+        started = time.perf_counter()
+        for i in range(int(rate * seconds)):
+            await asyncio.sleep(max(0.0, started + i / rate - time.perf_counter()))
+            tasks.append(asyncio.create_task(login()))
+        await asyncio.gather(*tasks)
+
+    async def probes():
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            await push_personal_message(conn.username, {"sent": time.perf_counter()})
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    started = time.perf_counter()
+    await asyncio.gather(logins(), probes())
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.05)
+    conn.close()
+
+    ms = [latency * 1000 for latency in socket.latencies]
+    print(
+        f"{mode:>6}: входов {stats['ok']} (отклонено {stats['rejected']}) за {elapsed:.1f} с; "
+        f"доставка p50 {percentile(ms, 0.5):.1f} мс, p99 {percentile(ms, 0.99):.1f} мс, "
+        f"max {max(ms):.1f} мс, сообщений {len(ms)}"
+    )
+
+async def main():
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    hashed = get_password_hash("password")
+    print(f"{rate} входов/с в течение {seconds:g} с, проба каждые {PROBE_INTERVAL * 1000:g} мс")
+    for mode in ("inline", "pool"):
+        await run(mode, rate, seconds, hashed)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+# CPU на сериализацию страницы истории, без базы:
+#   python bench_responses.py [строк]
+# Сравнивает путь через response_model (модель на каждую строку, как делает
+# FastAPI для возвращённых словарей) с json_response из main.py.
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import List
+from bson import Binary, ObjectId
+from pydantic import TypeAdapter
+from main import json_response, message_out
+from schemas import MessageOut
+
+ROUNDS = 50
+
+def page(rows: int) -> list:
+    started = datetime(2024, 1, 1)
+    raw = []
+    for i in range(rows):
+        msg = {"_id": ObjectId(), "sender": "alice", "receiver": "bob", "timestamp": started + timedelta(seconds=i)}
+        if i % 10 == 0:
+            msg["file_id"] = ObjectId()
+            msg["filename"] = "отчёт.pdf"
+        if i % 10 == 1:
+            msg["audio_file_id"] = ObjectId()
+            msg["voice"] = {"duration": 3.5, "waveform": Binary(bytes(range(64)))}
+        raw.append(msg)
+    return [message_out(msg, {}, f"сообщение номер {i}") for i, msg in enumerate(raw)]
+
+def best_ms(func) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    shaped = page(rows)
+    adapter = TypeAdapter(List[MessageOut])
+
+    def via_model():
+        return adapter.dump_json(adapter.validate_python(shaped))
+
+    per_1000 = 1000 / rows
+    print(f"{rows} сообщений, лучшее из {ROUNDS}; мс на 1000 сообщений:")
+    print(f"  response_model: {best_ms(via_model) * per_1000:7.2f}")
+    print(f"  json_response:  {best_ms(lambda: json_response(shaped)) * per_1000:7.2f}")
+
+if __name__ == "__main__":
+    main()
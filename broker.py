@@ -0,0 +1,135 @@
+from typing import List
+from bson import Timestamp
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+from models import db, invalidate_group, invalidate_user
+from connections import send_to_user, ws_stats
+import asyncio
+import json
+import os
+import time
+import uuid
+
+# Брокер доставки WebSocket-событий между процессами.
+#   local — всё в памяти одного процесса (uvicorn без --workers)
+#   mongo — события пишутся в capped-коллекцию, каждый процесс читает её
+#           tailable-курсором и доставляет своим подключениям. Работает и на
+#           одиночном mongod без replica set, в отличие от change streams.
+BROKER_BACKEND = os.getenv("REDFAX_BROKER", "local")
+EVENTS_COLLECTION = "ws_events"
+EVENTS_CAPPED_BYTES = 64 * 1024 * 1024
+
+# Кэши в памяти процесса, которые сбрасываются во всех процессах сразу:
+# вид -> функция сброса по ключу
+INVALIDATORS = {
+    "group": invalidate_group,  # участники группы
+    "user": invalidate_user,    # пользователь (auth, профиль, аватар)
+}
+
+def deliver_local(targets: List[str], text: str):
+    for username in targets:
+        send_to_user(username, text)
+
+class LocalBroker:
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, targets: List[str], text: str):
+        deliver_local(targets, text)
+
+    async def invalidate(self, kind: str, key: str):
+        INVALIDATORS[kind](key)
+
+    async def invalidate_group(self, group_id: str):
+        await self.invalidate("group", group_id)
+
+    async def invalidate_user(self, username: str):
+        await self.invalidate("user", username)
+
+def new_event(origin, targets: List[str], text, invalidate: list = None) -> dict:
+    # Пустой Timestamp в поле верхнего уровня сервер заменяет текущим: ts растёт
+    # монотонно на стороне MongoDB, в отличие от ObjectId, которые генерируют
+    # клиенты разных процессов, поэтому чтение продолжается по ts
+    event = {"ts": Timestamp(0, 0), "origin": origin, "targets": targets, "text": text}
+    if invalidate:
+        event["invalidate"] = invalidate  # [вид, ключ] из INVALIDATORS
+    return event
+
+class MongoBroker(LocalBroker):
+    def __init__(self):
+        self.origin = uuid.uuid4().hex  # id процесса, чтобы не доставлять свои события дважды
+        self.collection = db[EVENTS_COLLECTION]
+        self.tail_task = None
+
+    async def start(self):
+        if not await db.list_collection_names(filter={"name": EVENTS_COLLECTION}):
+            try:
+                await db.create_collection(EVENTS_COLLECTION, capped=True, size=EVENTS_CAPPED_BYTES)
+            except CollectionInvalid:
+                pass  # коллекцию создал соседний процесс
+        # Маркер старта: с него начинается чтение, и tailable-курсору есть за что зацепиться
+        result = await self.collection.insert_one(new_event(None, [], None))
+        marker = await self.collection.find_one({"_id": result.inserted_id}, {"ts": 1})
+        self.tail_task = asyncio.create_task(self._tail(marker["ts"]))
+
+    async def stop(self):
+        if self.tail_task:
+            self.tail_task.cancel()
+
+    async def publish(self, targets: List[str], text: str):
+        # Свои подключения получают событие сразу, остальные процессы — через коллекцию
+        deliver_local(targets, text)
+        await self.collection.insert_one(new_event(self.origin, targets, text))
+
+    async def invalidate(self, kind: str, key: str):
+        # Данные изменились — сбрасываем кэш у себя и во всех остальных процессах
+        INVALIDATORS[kind](key)
+        await self.collection.insert_one(new_event(self.origin, [], None, invalidate=[kind, key]))
+
+    async def _tail(self, last_ts: Timestamp):
+        while True:
+            # $gte: последнее прочитанное событие попадает в выборку, поэтому курсор
+            # не умирает сразу из-за пустого результата; его самого пропускаем ниже
+            cursor = self.collection.find({"ts": {"$gte": last_ts}}, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                # Один долгоживущий курсор: пустой getMore (await-data таймаут)
+                # завершает итерацию, но курсор остаётся живым
+                while cursor.alive:
+                    try:
+                        event = await cursor.next()
+                    except StopAsyncIteration:
+                        continue
+                    if event["ts"] <= last_ts:
+                        continue
+                    last_ts = event["ts"]
+                    if event["origin"] in (self.origin, None):
+                        continue
+                    if "invalidate" in event:
+                        kind, key = event["invalidate"]
+                        INVALIDATORS[kind](key)
+                    else:
+                        deliver_local(event["targets"], event["text"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"💥 Ошибка чтения {EVENTS_COLLECTION}: {e}")
+            finally:
+                await cursor.close()
+            # Курсор умирает, если отстали настолько, что событие под ним вытеснено
+            await asyncio.sleep(0.5)
+
+broker = MongoBroker() if BROKER_BACKEND == "mongo" else LocalBroker()
+
+async def push_personal_message(to_user: str, payload: dict):
+    await broker.publish([to_user], json.dumps(payload))
+
+async def push_group_message(group_members: List[str], from_user: str, payload: dict):
+    started = time.perf_counter()
+    # Сериализуем один раз на всю группу
+    targets = [member for member in group_members if member != from_user]
+    await broker.publish(targets, json.dumps(payload))
+    ws_stats["group_fanout_last_ms"] = (time.perf_counter() - started) * 1000
+    ws_stats["group_fanout_last_size"] = len(group_members)
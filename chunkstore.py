@@ -0,0 +1,295 @@
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime
+from itertools import accumulate
+from typing import Optional
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from models import db, fs_bucket
+from quota import charge_usage, release_usage
+import hashlib
+
+# Контент-адресуемое хранилище файлов под fs_bucket.
+#   cas_chunks — {_id: sha256 куска, data, size, refs}; одинаковые куски хранятся один раз
+#   fs.files   — манифест: обычный документ GridFS (filename, length, uploadDate,
+#                metadata) плюс поле chunks = [[sha256, size], ...]
+# У редактируемых текстовых документов в манифесте есть version: правки
+# (patch_file/replace_file) меняют куски под тем же _id и увеличивают версию.
+# Манифест лежит в fs.files, поэтому листинг файлов, квоты и поиск имён
+# работают как с обычными GridFS-файлами. Старые файлы без поля chunks
+# по-прежнему читаются и удаляются через GridFS.
+CAS_CHUNK_SIZE = 256 * 1024
+CAS_CHUNK_MIN = CAS_CHUNK_SIZE // 4  # куски мельче сливаются с соседями при правках
+CAS_WRITE_BATCH = 16  # кусков на один bulk_write (~4 МБ)
+
+chunks_collection = db.cas_chunks
+files_collection = db.fs.files
+
+def chunk_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+async def put_chunks(pieces: list) -> list:
+    """Сохраняет куски, увеличивая счётчик ссылок. Возвращает [[hash, size], ...].
+
+    Уже известные куски не переписываются: $setOnInsert срабатывает только
+    для новых, для остальных меняется лишь refs.
+    """
+    entries = []
+    ops = []
+    for data in pieces:
+        digest = chunk_hash(data)
+        entries.append([digest, len(data)])
+        ops.append(UpdateOne(
+            {"_id": digest},
+            {"$setOnInsert": {"data": data, "size": len(data)}, "$inc": {"refs": 1}},
+            upsert=True
+        ))
+    if ops:
+        await chunks_collection.bulk_write(ops, ordered=False)
+    return entries
+
+async def release_chunks(entries: list):
+    # Кусок может встречаться в файле несколько раз — снимаем столько же ссылок
+    counts = Counter(digest for digest, _ in entries)
+    if not counts:
+        return
+    await chunks_collection.bulk_write([
+        UpdateOne({"_id": digest}, {"$inc": {"refs": -n}}) for digest, n in counts.items()
+    ], ordered=False)
+    await chunks_collection.delete_many({"_id": {"$in": list(counts)}, "refs": {"$lte": 0}})
+
+async def write_stream(pieces) -> list:
+    """Пишет поток кусков (async-итератор bytes) в cas_chunks, возвращает записи манифеста.
+
+    Если поток оборвался (например, превышен размер), уже записанные
+    куски отпускаются.
+    """
+    entries = []
+    batch = []
+    buffer = b""
+    try:
+        async for piece in pieces:
+            buffer += piece
+            while len(buffer) >= CAS_CHUNK_SIZE:
+                batch.append(buffer[:CAS_CHUNK_SIZE])
+                buffer = buffer[CAS_CHUNK_SIZE:]
+            if len(batch) >= CAS_WRITE_BATCH:
+                entries += await put_chunks(batch)
+                batch = []
+        if buffer:
+            batch.append(buffer)
+        entries += await put_chunks(batch)
+    except BaseException:
+        await release_chunks(entries)
+        raise
+    return entries
+
+async def store_stream(pieces, filename: str, metadata: dict, version: int = None) -> ObjectId:
+    # version задаётся у редактируемых документов: их содержимое меняется под тем же id
+    entries = await write_stream(pieces)
+    try:
+        await charge_usage(metadata["user_id"], "fs", sum(size for _, size in entries))
+    except HTTPException:
+        await release_chunks(entries)
+        raise
+    return await create_manifest(filename, metadata, entries, version)
+
+async def create_manifest(filename: str, metadata: dict, entries: list, version: int = None) -> ObjectId:
+    file_id = ObjectId()
+    doc = {
+        "_id": file_id,
+        "filename": filename,
+        "length": sum(size for _, size in entries),
+        "chunkSize": CAS_CHUNK_SIZE,
+        "uploadDate": datetime.utcnow(),
+        "metadata": metadata,
+        "chunks": entries,
+    }
+    if version is not None:
+        doc["version"] = version
+    await files_collection.insert_one(doc)
+    return file_id
+
+async def commit_manifest(doc: dict, entries: list, new_entries: list, removed: list, filename: str = None) -> int:
+    """Подменяет куски манифеста, если его версия не изменилась. Возвращает новую версию.
+
+    new_entries — только что записанные куски (на них уже взяты ссылки),
+    removed — записи, которые из манифеста ушли. При конфликте версий
+    отпускаются новые куски и бросается 409.
+    """
+    version = doc["version"]
+    length = sum(size for _, size in entries)
+    update = {
+        "chunks": entries,
+        "length": length,
+        "uploadDate": datetime.utcnow(),
+    }
+    owner = doc["metadata"]["user_id"]
+    try:
+        await charge_usage(owner, "fs", length - doc["length"], files=0)
+    except HTTPException:
+        await release_chunks(new_entries)
+        raise
+    if filename is not None:
+        update["filename"] = filename
+    result = await files_collection.update_one(
+        {"_id": doc["_id"], "version": version},
+        {"$set": update, "$inc": {"version": 1}}
+    )
+    if result.matched_count == 0:
+        await release_usage(owner, "fs", length - doc["length"], files=0)
+        await release_chunks(new_entries)
+        raise HTTPException(status_code=409, detail="Документ уже изменён, обновите его")
+    await release_chunks(removed)
+    return version + 1
+
+async def replace_file(doc: dict, pieces, filename: str) -> int:
+    # Полная перезапись под тем же id: неизменившиеся куски дедуплицируются
+    entries = await write_stream(pieces)
+    return await commit_manifest(doc, entries, entries, doc["chunks"], filename)
+
+def split_even(data: bytes) -> list:
+    # Поровну на минимальное число кусков не больше CAS_CHUNK_SIZE: при длине
+    # от CAS_CHUNK_SIZE каждый кусок не меньше половины, мелкого хвоста нет
+    count = -(-len(data) // CAS_CHUNK_SIZE)
+    bounds = [i * len(data) // count for i in range(count + 1)] if count else []
+    return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+async def patch_file(doc: dict, patches: list, max_size: int) -> int:
+    """Применяет правки [(offset, length, replacement bytes), ...] к документу.
+
+    Читаются и переписываются только куски, которые правки задевают, и их
+    мелкие соседи — иначе вставки дробили бы документ на всё более мелкие
+    куски. Остальные записи манифеста остаются как есть.
+    """
+    # Рабочий список: [hash, size, data]; data не None — кусок создан этой правкой и ещё не записан
+    entries = [[digest, size, None] for digest, size in doc["chunks"]]
+    removed = []
+    length = doc["length"]
+    for offset, cut, replacement in patches:
+        if offset < 0 or cut < 0 or offset + cut > length:
+            raise HTTPException(status_code=400, detail="Правка выходит за границы документа")
+        offsets = list(accumulate((entry[1] for entry in entries), initial=0))
+        # Куски first..last (включительно) покрывают заменяемый диапазон и байт
+        # сразу за ним (по нему проверяется граница символа); вставка в конец
+        # документа дописывает последний кусок
+        first = max(bisect_right(offsets, offset) - 1, 0)
+        first = min(first, max(len(entries) - 1, 0))
+        last = max(min(bisect_right(offsets, offset + cut) - 1, len(entries) - 1), first)
+        if first > 0 and entries[first - 1][1] < CAS_CHUNK_MIN:
+            first -= 1
+        if last + 1 < len(entries) and entries[last + 1][1] < CAS_CHUNK_MIN:
+            last += 1
+        size = offsets[last + 1] - offsets[first] + len(replacement) - cut if entries else len(replacement)
+        if size < CAS_CHUNK_MIN:
+            # Результат мал сам по себе — сливаем его и с крупным соседом
+            if last + 1 < len(entries):
+                last += 1
+            elif first > 0:
+                first -= 1
+        touched = entries[first:last + 1]
+        data = b"".join(await _entry_data(touched))
+        start = offset - offsets[first]
+        if _inside_code_point(data, start) or _inside_code_point(data, start + cut):
+            raise HTTPException(status_code=400, detail="Граница правки попадает внутрь символа UTF-8")
+        data = data[:start] + replacement + data[start + cut:]
+        pieces = [[chunk_hash(piece), len(piece), piece] for piece in split_even(data)]
+        removed += [[digest, size] for digest, size, piece in touched if piece is None]
+        entries[first:last + 1] = pieces
+        length += len(replacement) - cut
+        if length > max_size:
+            raise HTTPException(status_code=400, detail="Файл превышает максимальный размер 50 МБ")
+
+    new_entries = await put_chunks([piece for _, _, piece in entries if piece is not None])
+    new_iter = iter(new_entries)
+    result = [next(new_iter) if piece is not None else [digest, size] for digest, size, piece in entries]
+    return await commit_manifest(doc, result, new_entries, removed)
+
+def _inside_code_point(data: bytes, position: int) -> bool:
+    # Смещения правок — в байтах UTF-8; байт продолжения 10xxxxxx означает,
+    # что граница разрезает многобайтовый символ
+    return position < len(data) and data[position] & 0xC0 == 0x80
+
+async def _entry_data(entries: list) -> list:
+    stored = [digest for digest, _, data in entries if data is None]
+    found = {}
+    if stored:
+        async for chunk in chunks_collection.find({"_id": {"$in": stored}}, {"data": 1}):
+            found[chunk["_id"]] = chunk["data"]
+    if len(found) < len(set(stored)):
+        # Куски уже отпущены параллельной правкой — манифест устарел
+        raise HTTPException(status_code=409, detail="Документ уже изменён, обновите его")
+    return [data if data is not None else found[digest] for digest, _, data in entries]
+
+async def delete_file(file_id: ObjectId):
+    doc = await files_collection.find_one_and_delete(
+        {"_id": file_id, "chunks": {"$exists": True}},
+        {"chunks": 1, "length": 1, "metadata.user_id": 1}
+    )
+    if doc is None:
+        # Файл из обычного GridFS
+        doc = await files_collection.find_one({"_id": file_id}, {"length": 1, "metadata.user_id": 1})
+        await fs_bucket.delete(file_id)
+    else:
+        await release_chunks(doc["chunks"])
+    if doc is not None and doc.get("metadata", {}).get("user_id"):
+        await release_usage(doc["metadata"]["user_id"], "fs", doc["length"])
+
+class ChunkedFileReader:
+    """Чтение файла из cas_chunks с тем же интерфейсом, что у GridOut (seek/read)."""
+
+    def __init__(self, doc: dict):
+        self._id = doc["_id"]
+        self.filename = doc["filename"]
+        self.length = doc["length"]
+        self.metadata = doc.get("metadata")
+        self.upload_date = doc["uploadDate"]
+        self.version = doc.get("version")
+        self._hashes = [digest for digest, _ in doc["chunks"]]
+        # Размеры кусков могут различаться (после частичных правок), поэтому
+        # позиция ищется по накопленным смещениям, а не делением на CAS_CHUNK_SIZE
+        self._offsets = list(accumulate((size for _, size in doc["chunks"]), initial=0))
+        self._position = 0
+        self._cached_index = None
+        self._cached_data = b""
+
+    def seek(self, position: int):
+        self._position = position
+
+    async def _chunk(self, index: int) -> Optional[bytes]:
+        if index != self._cached_index:
+            doc = await chunks_collection.find_one({"_id": self._hashes[index]}, {"data": 1})
+            if doc is None:
+                # Правка документа успела отпустить кусок, пока файл читался
+                return None
+            self._cached_index = index
+            self._cached_data = doc["data"]
+        return self._cached_data
+
+    async def read(self, size: int = -1) -> bytes:
+        # Возвращает не больше одного куска за вызов; b"" — конец файла или
+        # манифест устарел во время чтения (поток обрывается, а не падает)
+        if self._position >= self.length:
+            return b""
+        index = bisect_right(self._offsets, self._position) - 1
+        data = await self._chunk(index)
+        if data is None:
+            self._position = self.length
+            return b""
+        start = self._position - self._offsets[index]
+        piece = data[start:] if size < 0 else data[start:start + size]
+        self._position += len(piece)
+        return piece
+
+async def get_document(file_id: ObjectId):
+    # Манифест редактируемого документа или None
+    return await files_collection.find_one(
+        {"_id": file_id, "chunks": {"$exists": True}, "version": {"$exists": True}}
+    )
+
+async def open_file(file_id: ObjectId):
+    doc = await files_collection.find_one({"_id": file_id, "chunks": {"$exists": True}})
+    if doc is not None:
+        return ChunkedFileReader(doc)
+    return await fs_bucket.open_download_stream(file_id)
@@ -0,0 +1,88 @@
+from typing import Dict, Set
+from fastapi import WebSocket
+from starlette.status import WS_1011_INTERNAL_ERROR, WS_1013_TRY_AGAIN_LATER
+import asyncio
+
+# Сколько исходящих сообщений может ждать отправки на один сокет.
+# Клиент, который не успевает их разбирать, отключается, а не тормозит остальных.
+OUTBOUND_QUEUE_SIZE = 256
+
+ws_stats = {
+    "dropped_slow_consumers": 0,
+    "group_fanout_last_ms": 0.0,
+    "group_fanout_last_size": 0,
+}
+
+class Connection:
+    """Сокет пользователя с собственной очередью отправки и задачей-писателем."""
+
+    def __init__(self, username: str, websocket: WebSocket):
+        self.username = username
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.closed = False
+        self.writer = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Без кода сокет остался бы открытым, но уже без пушей — закрываем, чтобы клиент переподключился
+            self.close(code=WS_1011_INTERNAL_ERROR)
+
+    def enqueue(self, text: str):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            ws_stats["dropped_slow_consumers"] += 1
+            self.close(code=WS_1013_TRY_AGAIN_LATER)
+
+    def close(self, code: int = None):
+        if self.closed:
+            return
+        self.closed = True
+        remove_connection(self)
+        if asyncio.current_task() is not self.writer:
+            self.writer.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+# username -> множество открытых подключений (несколько вкладок / устройств)
+active_connections_ws: Dict[str, Set[Connection]] = {}
+
+def add_connection(username: str, websocket: WebSocket) -> Connection:
+    conn = Connection(username, websocket)
+    active_connections_ws.setdefault(username, set()).add(conn)
+    return conn
+
+def remove_connection(conn: Connection):
+    # Убираем только это подключение; остальные подключения пользователя живут дальше
+    conns = active_connections_ws.get(conn.username)
+    if conns is None:
+        return
+    conns.discard(conn)
+    if not conns:
+        del active_connections_ws[conn.username]
+
+def is_online(username: str) -> bool:
+    return username in active_connections_ws
+
+def connection_count() -> int:
+    return sum(len(conns) for conns in active_connections_ws.values())
+
+def send_to_user(username: str, text: str):
+    # Не ждёт сети: кладёт уже сериализованный текст в очереди сокетов
+    for conn in list(active_connections_ws.get(username, ())):
+        conn.enqueue(text)
@@ -1,16 +1,110 @@
 from Crypto.Cipher import AES
-import base64
+import asyncio
+import binascii
+import hashlib
+import hmac
+import re
 
 AES_KEY = b"1234567890abcdef"  # 16 байт
+SEARCH_KEY = b"redfax-search-index-key"  # ключ HMAC для поискового индекса
 
-def encrypt_message(message: str) -> str:
+# Слова короче не индексируются; у длинных сообщений берутся первые N разных слов
+SEARCH_MIN_TOKEN = 2
+SEARCH_MAX_TOKENS = 256
+_TOKEN_RE = re.compile(r"\w+")
+
+# Пакеты больше этих порогов обрабатываются в отдельном потоке, чтобы не
+# держать event loop. Основная цена — создание шифра на каждое сообщение,
+# у длинных текстов добавляются байты (замеры: python bench_crypto.py).
+# Порог по количеству ниже MESSAGES_PAGE_MAX, иначе полная страница истории
+# не выносилась бы.
+BATCH_THREAD_THRESHOLD = 32
+BATCH_THREAD_BYTES = 32 * 1024
+
+# Формат хранения: BSON Binary = версия (1 байт) + nonce (16) + tag (16) + шифртекст.
+# Старые записи — base64-строка без байта версии, читаются прозрачно.
+CIPHERTEXT_V1 = 1
+
+def encrypt_message(message: str) -> bytes:
     cipher = AES.new(AES_KEY, AES.MODE_EAX)
     ciphertext, tag = cipher.encrypt_and_digest(message.encode())
-    result = cipher.nonce + tag + ciphertext
-    return base64.b64encode(result).decode()
+    return bytes((CIPHERTEXT_V1,)) + cipher.nonce + tag + ciphertext
 
-def decrypt_message(encrypted: str) -> str:
-    raw = base64.b64decode(encrypted)
-    nonce, tag, ciphertext = raw[:16], raw[16:32], raw[32:]
+def _unpack(encrypted):
+    if isinstance(encrypted, str):
+        raw = memoryview(binascii.a2b_base64(encrypted))
+    else:
+        raw = memoryview(encrypted)
+        if raw[0] != CIPHERTEXT_V1:
+            raise ValueError(f"Неизвестная версия шифртекста: {raw[0]}")
+        raw = raw[1:]
+    # Срезы memoryview не копируют байты для каждого поля
+    return raw[:16], raw[16:32], raw[32:]
+
+def legacy_to_binary(encrypted: str) -> bytes:
+    # Перепаковка base64-строки в бинарный формат без расшифровки
+    return bytes((CIPHERTEXT_V1,)) + binascii.a2b_base64(encrypted)
+
+def decrypt_message(encrypted) -> str:
+    nonce, tag, ciphertext = _unpack(encrypted)
     cipher = AES.new(AES_KEY, AES.MODE_EAX, nonce=nonce)
     return cipher.decrypt_and_verify(ciphertext, tag).decode()
+
+def encrypt_many(messages: list) -> list:
+    # None пропускается как есть (голосовые и файловые сообщения без текста)
+    new = AES.new
+    mode = AES.MODE_EAX
+    version = bytes((CIPHERTEXT_V1,))
+    out = []
+    for message in messages:
+        if message is None:
+            out.append(None)
+            continue
+        cipher = new(AES_KEY, mode)
+        ciphertext, tag = cipher.encrypt_and_digest(message.encode())
+        out.append(version + cipher.nonce + tag + ciphertext)
+    return out
+
+def decrypt_many(encrypted: list) -> list:
+    new = AES.new
+    mode = AES.MODE_EAX
+    out = []
+    for item in encrypted:
+        if not item:
+            out.append(None)
+            continue
+        nonce, tag, ciphertext = _unpack(item)
+        cipher = new(AES_KEY, mode, nonce=nonce)
+        out.append(cipher.decrypt_and_verify(ciphertext, tag).decode())
+    return out
+
+def _offload(items: list) -> bool:
+    if len(items) > BATCH_THREAD_THRESHOLD:
+        return True
+    return sum(len(item) for item in items if item) > BATCH_THREAD_BYTES
+
+async def decrypt_many_async(encrypted: list) -> list:
+    if _offload(encrypted):
+        return await asyncio.to_thread(decrypt_many, encrypted)
+    return decrypt_many(encrypted)
+
+async def encrypt_many_async(messages: list) -> list:
+    if _offload(messages):
+        return await asyncio.to_thread(encrypt_many, messages)
+    return encrypt_many(messages)
+
+def search_token_hashes(text: str) -> list:
+    """Ключевые хеши (HMAC-SHA256, 16 байт) уникальных слов текста.
+
+    В индекс попадают только хеши, поэтому открытый текст на сервере не хранится.
+    """
+    tokens = []
+    seen = set()
+    for token in _TOKEN_RE.findall(text.lower()):
+        if len(token) < SEARCH_MIN_TOKEN or token in seen:
+            continue
+        seen.add(token)
+        tokens.append(hmac.new(SEARCH_KEY, token.encode(), hashlib.sha256).digest()[:16])
+        if len(tokens) >= SEARCH_MAX_TOKENS:
+            break
+    return tokens
@@ -1,26 +1,25 @@
 from typing import List, Dict
-from datetime import timedelta
+from datetime import timedelta, timezone
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from email.utils import format_datetime
 from schemas import *
 from models import *
 from auth import *
-from crypto import encrypt_message, decrypt_message
+from crypto import encrypt_message, decrypt_message, decrypt_many_async
 from bson import ObjectId
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, APIRouter, WebSocket, WebSocketDisconnect, Body, Query, Form
+from bson.errors import InvalidId
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, APIRouter, WebSocket, WebSocketDisconnect, Body, Query, Form, Request
+from connections import *
+from broker import broker, push_personal_message, push_group_message
+from chunkstore import store_stream, open_file, get_document, replace_file, patch_file, delete_file as delete_chunked_file
+from media import media_queue, media_stats, make_avatar_thumbnails, delete_thumbnails, analyze_voice, AVATAR_THUMB_SIZES
+from quota import charge_usage, check_usage, release_usage, bucket_name, reconcile_usage_forever
+from mongo_stats import MONGO_STATS_ENABLED, request_mongo_stats, record_request, mongo_stats_report
+from urllib.parse import quote
+from pydantic_core import to_json
 import json
 
-# Утилиты для пуша
-async def push_personal_message(to_user: str, payload: dict):
-    ws = active_connections_ws.get(to_user)
-    if ws:
-        await ws.send_text(json.dumps(payload))
-
-async def push_group_message(group_members: List[str], from_user: str, payload: dict):
-    for member in group_members:
-        if member != from_user and member in active_connections_ws:
-            await active_connections_ws[member].send_text(json.dumps(payload))
-
 app = FastAPI()
 router = APIRouter()
 
@@ -32,18 +31,102 @@ app.add_middleware(
     allow_methods=["*"],
 )
 
+async def count_mongo_bytes(request: Request, call_next):
+    stats = {"commands": 0, "bytes": 0}
+    token = request_mongo_stats.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        request_mongo_stats.reset(token)
+    route = request.scope.get("route")
+    record_request(f"{request.method} {route.path if route else request.url.path}", stats)
+    response.headers["X-Mongo-Bytes"] = str(stats["bytes"])
+    return response
+
+# Без учёта запросы не проходят через лишний слой middleware
+if MONGO_STATS_ENABLED:
+    app.middleware("http")(count_mongo_bytes)
+
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+    await broker.start()
+    await media_queue.start()
+    app.state.reconcile_task = asyncio.create_task(reconcile_usage_forever())
+    app.state.migration_task = asyncio.create_task(migrate_conversation_ids_at_startup())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.reconcile_task.cancel()
+    app.state.migration_task.cancel()
+    await media_queue.stop()
+    await broker.stop()
+
 ### НАСТРОЙКИ ###
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 мегабайт
-MAX_FILE_COUNT = 20
+UPLOAD_CHUNK_SIZE = 255 * 1024  # совпадает с размером чанка GridFS
+
+async def read_upload(file: UploadFile, max_size: int):
+    # Отдаёт UploadFile кусками; при превышении max_size бросает 400 посреди потока
+    if file.size is not None and file.size > max_size:
+        raise HTTPException(400, detail="Файл превышает максимальный размер 50 МБ")
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise HTTPException(400, detail="Файл превышает максимальный размер 50 МБ")
+        yield chunk
+
+async def save_upload(bucket, file: UploadFile, metadata: dict, max_size: int = MAX_FILE_SIZE, version: int = None):
+    """Потоково пишет UploadFile в хранилище кусками, не держа файл целиком в памяти.
+
+    Обычные файлы идут в дедуплицирующее хранилище (chunkstore), голосовые и
+    аватары — в свои GridFS-бакеты. При превышении max_size загрузка
+    прерывается, уже записанные куски удаляются. version помечает
+    редактируемый документ (см. PATCH /text).
+
+    Размер списывается с квоты владельца (metadata["user_id"]) до того, как
+    файл станет виден; при превышении квоты загрузка откатывается. Владелец,
+    уже упёршийся в квоту, получает отказ до приёма тела.
+    """
+    await check_usage(metadata["user_id"], bucket_name(bucket), file.size)
+    if bucket is fs_bucket:
+        return await store_stream(read_upload(file, max_size), file.filename, metadata, version)
+
+    grid_in = bucket.open_upload_stream(file.filename, metadata=metadata)
+    size = 0
+    try:
+        async for chunk in read_upload(file, max_size):
+            await grid_in.write(chunk)
+            size += len(chunk)
+        await charge_usage(metadata["user_id"], bucket_name(bucket), size)
+    except BaseException:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+    return grid_in._id
+
+async def delete_upload(bucket, file_id: ObjectId):
+    # Удаляет файл и возвращает его место в квоту владельца
+    if bucket is fs_bucket:
+        await delete_chunked_file(file_id)
+        return
+    name = bucket_name(bucket)
+    doc = await db[f"{name}.files"].find_one({"_id": file_id}, {"length": 1, "metadata.user_id": 1})
+    await bucket.delete(file_id)
+    if doc is not None and doc.get("metadata", {}).get("user_id"):
+        await release_usage(doc["metadata"]["user_id"], name, doc["length"])
 
 ### АУНТИФИКАЦИЯ ###
 
 @app.post("/register")
 async def register(user: UserCreate):
-    existing = await get_user(user.username)
-    if existing:
+    if await user_exists(user.username):
         raise HTTPException(status_code=400, detail="User already exists")
-    hashed = get_password_hash(user.password)
+    hashed = await get_password_hash_async(user.password)
     await create_user(user.username, hashed)
     return {"message": "User registered"}
 
@@ -58,43 +141,85 @@ async def login(user: UserLogin):
     )
     return {"access_token": token, "token_type": "bearer"}
 
+### МЕТРИКИ ###
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "password_hash_queue_depth": password_queue_depth(),
+        "ws_connections": connection_count(),
+        **{f"ws_{key}": value for key, value in ws_stats.items()},
+        "media_queue_depth": media_queue.depth(),
+        **{f"media_{key}": value for key, value in media_stats.items()},
+        "mongo_bytes_by_route": mongo_stats_report(),
+    }
+
 ### СООБЩЕНИЯ ###
 
+async def send_personal_text(sender: str, receiver: str, content: str, client_id: Optional[str] = None):
+    """Сохраняет личное текстовое сообщение и пушит его получателю.
+
+    Общий путь для REST и WebSocket; повтор с тем же client_id не пушится.
+    """
+    doc, created = await create_message(
+        sender=sender,
+        receiver=receiver,
+        content=encrypt_message(content),
+        client_id=client_id
+    )
+    if created:
+        await index_message(search_scope(sender, receiver), doc, content)
+        await push_personal_message(receiver, {
+            "type": "new_message",
+            "data": {
+                "id": str(doc["_id"]),
+                "sender": sender,
+                "receiver": receiver,
+                "content": content,
+                "timestamp": doc["timestamp"].isoformat()
+            }
+        })
+    return doc
+
+async def send_group_text(sender: str, group_id: str, content: str, client_id: Optional[str] = None):
+    members = await require_group_member(group_id, sender)
+
+    doc, created = await send_group_message(sender, group_id, content, client_id)
+    if created:
+        await index_message(search_scope(group_id=group_id), doc, content)
+        await push_group_message(members, sender, {
+            "type": "new_group_message",
+            "data": {
+                "id": str(doc["_id"]),
+                "sender": sender,
+                "group_id": group_id,
+                "content": content,
+                "timestamp": doc["timestamp"].isoformat()
+            }
+        })
+    return doc
+
 @app.post("/send/message")
 async def send_message(
     payload: MessagePayload,
     current_user: dict = Depends(get_current_user)
 ):
-    receiver = payload.receiver
-    content = payload.content
-
-    # … ваши валидации …
-    encrypted_content = encrypt_message(content)
-
-    # 1) сохраняем в БД
-    await create_message(
-        sender=current_user["username"],
-        receiver=receiver,
-        content=encrypted_content,
-        audio_file_id=None
-    )
-
-    # 2) формируем объект, который придёт клиенту
-    message_data = {
-        "sender": current_user["username"],
-        "receiver": receiver,
-        "content": content,
-        "timestamp": datetime.utcnow().isoformat()
-    }
-    payload_ws = {
-        "type": "new_message",
-        "data": message_data
-    }
-
-    # 3) пушим через WS, если получатель онлайн
-    await push_personal_message(receiver, payload_ws)
+    if bool(payload.receiver) == bool(payload.group_id):
+        raise HTTPException(400, detail="Нужно указать либо receiver, либо group_id")
 
-    return JSONResponse({"message": "Сообщение отправлено"}, status_code=201)
+    if payload.group_id:
+        doc = await send_group_text(
+            current_user["username"], payload.group_id, payload.content, payload.client_id
+        )
+    else:
+        doc = await send_personal_text(
+            current_user["username"], payload.receiver, payload.content, payload.client_id
+        )
+    return JSONResponse({
+        "message": "Сообщение отправлено",
+        "id": str(doc["_id"]),
+        "timestamp": doc["timestamp"].isoformat()
+    }, status_code=201)
 
 
 @app.post("/send/voice")
@@ -105,21 +230,23 @@ async def send_voice_message(
     current_user: dict = Depends(get_current_user)
 ):
     # … ваши валидации и загрузка в GridFS …
-    contents = await audio_file.read()
-    file_id = await voice_fs_bucket.upload_from_stream(
-        audio_file.filename, contents,
+    if not receiver:
+        members = await require_group_member(group_id, current_user["username"])
+    file_id = await save_upload(
+        voice_fs_bucket, audio_file,
         metadata={"user_id": current_user["username"], "type": "voice"}
     )
     audio_file_id = str(file_id)
 
     if receiver:
         # личка
-        await create_message(
+        doc, _ = await create_message(
             sender=current_user["username"],
             receiver=receiver,
             content=None,
             audio_file_id=audio_file_id
         )
+        media_queue.submit(analyze_voice, file_id, "messages", doc["_id"])
         message_data = {
             "sender": current_user["username"],
             "receiver": receiver,
@@ -131,13 +258,13 @@ async def send_voice_message(
         return JSONResponse({"message": "Голосовое сообщение отправлено"}, status_code=201)
 
     # группа
-    group = await get_group_by_id(group_id)
-    await db.group_messages.insert_one({
+    result = await db.group_messages.insert_one({
         "group_id": group_id,
         "sender": current_user["username"],
         "audio_file_id": audio_file_id,
         "timestamp": datetime.utcnow()
     })
+    media_queue.submit(analyze_voice, file_id, "group_messages", result.inserted_id)
     message_data = {
         "sender": current_user["username"],
         "group_id": group_id,
@@ -145,44 +272,65 @@ async def send_voice_message(
         "timestamp": datetime.utcnow().isoformat()
     }
     payload_ws = {"type": "new_group_voice_message", "data": message_data}
-    await push_group_message(group["members"], current_user["username"], payload_ws)
+    await push_group_message(members, current_user["username"], payload_ws)
     return JSONResponse({"message": "Голосовое сообщение отправлено в группу"}, status_code=201)
 
-@app.get("/messages", response_model=List[MessageOut])
-async def get_messages(current_user: dict = Depends(get_current_user)):
-    raw_msgs = await get_messages_for_user(current_user["username"])
-    result = []
+# Списочные эндпоинты отдают готовые словари в форме response_model через
+# json_response: FastAPI не строит и не перепроверяет модель на каждую строку,
+# формы сверяются с моделями один раз в tests/test_shapes.py. response_model
+# остаётся для документации OpenAPI. Замер: python bench_responses.py
+def json_response(content) -> Response:
+    return Response(to_json(content), media_type="application/json")
 
-    for msg in raw_msgs:
-        audio_url = None
-        file_url = None
-        filename = None
-        file_id = msg.get("file_id")
+def message_out(msg: dict, filenames: dict, content: Optional[str]) -> dict:
+    audio_url = None
+    file_url = None
+    filename = None
+    file_id = msg.get("file_id")
+    voice = msg.get("voice") or {}
 
-        if msg.get("audio_file_id"):
-            audio_url = f"/voice/{msg['audio_file_id']}"
+    if msg.get("audio_file_id"):
+        audio_url = f"/voice/{msg['audio_file_id']}"
 
-        if file_id:
-            file_url = f"/file/{file_id}"
-            try:
-                file_doc = await db.fs.files.find_one({"_id": ObjectId(file_id)})
-                if file_doc:
-                    filename = file_doc["filename"]
-            except:
-                pass
-
-        result.append(MessageOut(
-            sender=msg["sender"],
-            receiver=msg["receiver"],
-            content=decrypt_message(msg["content"]) if msg.get("content") else None,
-            audio_url=audio_url,
-            file_id=str(file_id) if file_id else None,
-            file_url=file_url,
-            filename=filename,
-            timestamp=msg["timestamp"]
-        ))
-
-    return result
+    if file_id:
+        file_url = f"/file/{file_id}"
+        filename = msg.get("filename") or filenames.get(str(file_id))
+
+    return {
+        "id": str(msg["_id"]),
+        "cursor": encode_cursor(msg),
+        "sender": msg["sender"],
+        # для групповых сообщений "receiver" — это id группы
+        "receiver": msg.get("group_id") or msg["receiver"],
+        "content": content,
+        "audio_url": audio_url,
+        "audio_duration": voice.get("duration"),
+        "audio_waveform": list(voice["waveform"]) if "waveform" in voice else None,
+        "file_id": str(file_id) if file_id else None,
+        "file_url": file_url,
+        "filename": filename,
+        "timestamp": msg["timestamp"],
+    }
+
+async def messages_out(raw_msgs: list) -> List[dict]:
+    # Имена файлов одним запросом, расшифровка всей страницы одним батчем
+    filenames = await resolve_filenames(raw_msgs)
+    contents = await decrypt_many_async([msg.get("content") for msg in raw_msgs])
+    return [message_out(msg, filenames, content) for msg, content in zip(raw_msgs, contents)]
+
+@app.get("/messages", response_model=List[MessageOut])
+async def get_messages(
+    peer: Optional[str] = Query(None),
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+    current_user: dict = Depends(get_current_user)
+):
+    # Страница истории от новых к старым; курсор последнего элемента -> before
+    raw_msgs = await get_messages_for_user(
+        current_user["username"], peer=peer, before=before, after=after, limit=limit
+    )
+    return json_response(await messages_out(raw_msgs))
 
 @app.post("/send/file")
 async def send_file_message(
@@ -202,13 +350,20 @@ async def send_file_message(
     if file and file_id:
         raise HTTPException(400, detail="Укажите либо file, либо file_id, не оба")
 
+    # Адресата проверяем до загрузки: иначе отклонённый запрос уже занял бы квоту
+    if receiver:
+        if not await user_exists(receiver):
+            raise HTTPException(404, detail="Получатель не найден")
+    else:
+        await require_group_member(group_id, current_user["username"])
+
     # Загружаем файл, если передан
     uploaded_file_id = None
+    uploaded_filename = None
     if file:
-        contents = await file.read()
-        result_id = await fs_bucket.upload_from_stream(
-            file.filename,
-            contents,
+        result_id = await save_upload(
+            fs_bucket,
+            file,
             metadata={
                 "user_id": current_user["username"],
                 "content_type": file.content_type,
@@ -216,43 +371,39 @@ async def send_file_message(
             }
         )
         uploaded_file_id = str(result_id)
+        uploaded_filename = file.filename
     else:
         # Проверка, существует ли указанный file_id
         try:
-            file_obj = await fs_bucket.find({"_id": ObjectId(file_id)}).to_list(1)
+            file_obj = await db.fs.files.find_one({"_id": ObjectId(file_id)}, {"filename": 1})
             if not file_obj:
                 raise HTTPException(404, detail="Указанный файл не найден")
             uploaded_file_id = file_id
+            uploaded_filename = file_obj["filename"]
+        except HTTPException:
+            raise
         except Exception:
             raise HTTPException(400, detail="Неверный file_id")
 
     # Сохраняем сообщение
     if receiver:
-        rec_user = await get_user(receiver)
-        if not rec_user:
-            raise HTTPException(404, detail="Получатель не найден")
-
         await create_message(
             sender=current_user["username"],
             receiver=receiver,
             content=None,
             audio_file_id=None,
-            file_id=uploaded_file_id  # ← Новый аргумент в функции
+            file_id=uploaded_file_id,  # ← Новый аргумент в функции
+            filename=uploaded_filename
         )
         return {"message": "Файл отправлен в личку"}
 
-    group = await get_group_by_id(group_id)
-    if not group:
-        raise HTTPException(404, detail="Группа не найдена")
-    if current_user["username"] not in group["members"]:
-        raise HTTPException(403, detail="Вы не состоите в группе")
-
     await db.group_messages.insert_one({
         "group_id": group_id,
         "sender": current_user["username"],
         "content": None,
         "audio_file_id": None,
         "file_id": uploaded_file_id,
+        "filename": uploaded_filename,
         "timestamp": datetime.utcnow()
     })
     return {"message": "Файл отправлен в группу"}
@@ -264,8 +415,7 @@ async def add_friend(req: FriendAddRequest, current_user: dict = Depends(get_cur
     if req.username == current_user["username"]:
         raise HTTPException(status_code=400, detail="Cannot add yourself")
 
-    friend = await get_user(req.username)
-    if not friend:
+    if not await user_exists(req.username):
         raise HTTPException(status_code=404, detail="User not found")
 
     # Добавляем друга в список текущего пользователя
@@ -285,21 +435,10 @@ async def list_friends(current_user: dict = Depends(get_current_user)):
 
 @app.post("/file")
 async def upload_file(user_id: str, file: UploadFile = File(...)):
-    contents = await file.read()
-
-    # ⛔ Проверка размера файла
-    if len(contents) > MAX_FILE_SIZE:
-        raise HTTPException(400, detail="Файл превышает максимальный размер 50 МБ")
-
-    # ⛔ Проверка количества файлов
-    file_count = await count_user_files(user_id)
-    if file_count >= MAX_FILE_COUNT:
-        raise HTTPException(400, detail="Превышено максимальное количество файлов: 20")
-
-    # ✅ Загрузка
-    file_id = await fs_bucket.upload_from_stream(
-        file.filename,
-        contents,
+    # ✅ Загрузка (размер проверяется по ходу записи, квота — атомарно после неё)
+    file_id = await save_upload(
+        fs_bucket,
+        file,
         metadata={"user_id": user_id, "content_type": file.content_type}
     )
 
@@ -307,37 +446,145 @@ async def upload_file(user_id: str, file: UploadFile = File(...)):
 
 @app.get("/files")
 async def list_files(user_id: str):
-    cursor = db.fs.files.find({"metadata.user_id": user_id})
+    cursor = db.fs.files.find(
+        {"metadata.user_id": user_id},
+        {"filename": 1, "metadata.content_type": 1, "version": 1}
+    )
     files = []
     async for doc in cursor:
-        files.append({
+        item = {
             "file_id": str(doc["_id"]),
             "filename": doc["filename"],
             "content_type": doc["metadata"].get("content_type"),
-        })
+        }
+        if "version" in doc:
+            item["version"] = doc["version"]
+        files.append(item)
     return files
 
-@app.get("/file/{file_id}")
-async def get_file(file_id: str):
+def parse_range(range_header: Optional[str], length: int):
+    """Разбирает заголовок Range: bytes=start-end | start- | -suffix.
+
+    Возвращает (start, end) включительно, None если заголовка нет, он не
+    поддерживается (несколько диапазонов), неверен синтаксически или
+    перевёрнут — тогда отдаём файл целиком, как требует RFC 9110.
+    416 — только для корректного, но невыполнимого диапазона.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+    start_s, _, end_s = spec.partition("-")
+    if not (start_s or end_s) or any(part and not part.isdigit() for part in (start_s, end_s)):
+        return None
+    # Пустой файл целиком — ответ на любой диапазон (плееры шлют bytes=0-)
+    if length == 0:
+        return None
+
+    if start_s:
+        start = int(start_s)
+        end = int(end_s) if end_s else length - 1
+        if end_s and end < start:
+            return None
+    else:
+        suffix = int(end_s)
+        if suffix == 0:
+            raise HTTPException(416, detail="Неверный диапазон", headers={"Content-Range": f"bytes */{length}"})
+        start = max(length - suffix, 0)
+        end = length - 1
+    if start >= length:
+        raise HTTPException(416, detail="Неверный диапазон", headers={"Content-Range": f"bytes */{length}"})
+    return start, min(end, length - 1)
+
+async def iter_grid_out(grid_out, start: int, length: int):
+    # seek сразу переходит к нужному чанку GridFS, а не читает с нулевого байта
+    if start:
+        grid_out.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = await grid_out.read(min(remaining, UPLOAD_CHUNK_SIZE))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+# Блобы адресуются ObjectId и не меняются на месте (правка = новый id),
+# поэтому id годится как сильный ETag, а кэш можно держать сколько угодно.
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+def make_etag(file_id) -> str:
+    return f'"{file_id}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in candidates
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+async def gridfs_response(bucket, file_id: str, request: Request, cache_control: str = IMMUTABLE_CACHE_CONTROL):
+    # Повторный запрос с тем же ETag не трогает базу вообще
+    etag = make_etag(file_id)
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+
     try:
-        stream = await fs_bucket.open_download_stream(ObjectId(file_id))
-        return StreamingResponse(stream, media_type=stream.metadata.get("content_type"))
+        if bucket is fs_bucket:
+            grid_out = await open_file(ObjectId(file_id))
+        else:
+            grid_out = await bucket.open_download_stream(ObjectId(file_id))
     except Exception:
         raise HTTPException(status_code=404, detail="File not found")
-    
+
+    version = getattr(grid_out, "version", None)
+    if version is not None:
+        # Редактируемый документ меняется под тем же id — кэшировать навсегда нельзя
+        etag = f'"{file_id}.{version}"'
+        cache_control = "private, no-cache"
+        if etag_matches(request, etag):
+            return not_modified(etag, cache_control)
+
+    media_type = (grid_out.metadata or {}).get("content_type")
+    length = grid_out.length
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Last-Modified": format_datetime(grid_out.upload_date.replace(tzinfo=timezone.utc), usegmt=True),
+    }
+
+    byte_range = parse_range(request.headers.get("range"), length)
+    if byte_range is None:
+        headers["Content-Length"] = str(length)
+        return StreamingResponse(iter_grid_out(grid_out, 0, length), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    return StreamingResponse(
+        iter_grid_out(grid_out, start, end - start + 1),
+        status_code=206, media_type=media_type, headers=headers
+    )
+
+@app.get("/file/{file_id}")
+async def get_file(file_id: str, request: Request):
+    return await gridfs_response(fs_bucket, file_id, request)
+
 @app.get("/voice/{file_id}")
-async def get_file(file_id: str):
-    try:
-        stream = await voice_fs_bucket.open_download_stream(ObjectId(file_id))
-        return StreamingResponse(stream, media_type=stream.metadata.get("content_type"))
-    except Exception:
-        raise HTTPException(status_code=404, detail="File not found")
-    
+async def get_voice(file_id: str, request: Request):
+    return await gridfs_response(voice_fs_bucket, file_id, request)
+
 @app.delete("/file/{file_id}")
 async def delete_file(file_id: str):
     try:
         oid = ObjectId(file_id)
-        await fs_bucket.delete(oid)
+        await delete_chunked_file(oid)
         return {"message": "File deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")
@@ -351,17 +598,24 @@ async def upload_text_file(
     if not file.content_type.startswith("text/"):
         raise HTTPException(status_code=400, detail="Можно загружать только текстовые файлы")
 
-    contents = await file.read()  # bytes
-    # Можно проверить размер, если нужно
-
-    # Загружаем в GridFS
-    file_id = await fs_bucket.upload_from_stream(
-        file.filename,
-        contents,
-        metadata={"user_id": user_id, "content_type": file.content_type}
+    # Загружаем как редактируемый документ: дальнейшие правки идут через PATCH /text/{id}
+    file_id = await save_upload(
+        fs_bucket,
+        file,
+        metadata={"user_id": user_id, "content_type": file.content_type},
+        version=0
     )
 
-    return {"file_id": str(file_id)}
+    return {"file_id": str(file_id), "version": 0}
+
+async def get_text_document(file_id: str, user_id: str) -> Optional[dict]:
+    try:
+        doc = await get_document(ObjectId(file_id))
+    except InvalidId:
+        raise HTTPException(status_code=404, detail="File not found")
+    if doc is not None and doc["metadata"].get("user_id") != user_id:
+        raise HTTPException(status_code=403, detail="Нет доступа к документу")
+    return doc
 
 @app.put("/text/{file_id}")
 async def update_text_file_in_gridfs(
@@ -373,26 +627,46 @@ async def update_text_file_in_gridfs(
     if not file.content_type.startswith("text/"):
         raise HTTPException(status_code=400, detail="Можно загружать только текстовые файлы")
 
-    # Удаляем старый файл из GridFS
-    await fs_bucket.delete(ObjectId(file_id))
-
-    contents = await file.read()
-    # Загружаем новый файл
-    new_file_id = await fs_bucket.upload_from_stream(
-        file.filename,
-        contents,
-        metadata={"user_id": user_id, "content_type": file.content_type}
+    doc = await get_text_document(file_id, user_id)
+    if doc is not None:
+        # Перезаписываем под тем же id, ссылки в сообщениях остаются рабочими
+        if file.size is not None:
+            await check_usage(user_id, "fs", max(0, file.size - doc["length"]), files=0)
+        version = await replace_file(doc, read_upload(file, MAX_FILE_SIZE), file.filename)
+        return {"new_file_id": file_id, "version": version}
+
+    # Старый файл (не документ): загружаем новый и превращаем его в документ
+    new_file_id = await save_upload(
+        fs_bucket,
+        file,
+        metadata={"user_id": user_id, "content_type": file.content_type},
+        version=0
     )
 
-    return {"new_file_id": str(new_file_id)}
+    # Удаляем старый файл только после успешной загрузки нового
+    await delete_chunked_file(ObjectId(file_id))
+
+    return {"new_file_id": str(new_file_id), "version": 0}
+
+@app.patch("/text/{file_id}")
+async def patch_text_file(file_id: str, body: TextPatchRequest, user_id: str = Query(...)):
+    # Автосохранение редактора: приходят только изменённые фрагменты
+    doc = await get_text_document(file_id, user_id)
+    if doc is None:
+        raise HTTPException(status_code=404, detail="Документ не найден")
+    if doc["version"] != body.base_version:
+        raise HTTPException(status_code=409, detail="Документ уже изменён, обновите его")
+
+    patches = [(p.offset, p.length, p.replacement.encode("utf-8")) for p in body.patches]
+    version = await patch_file(doc, patches, MAX_FILE_SIZE)
+    return {"file_id": file_id, "version": version}
 
 ### ПРОФИЛЬ ###
 
 @app.get("/profile", response_model=UserProfile)
 async def get_profile(current_user: dict = Depends(get_current_user)):
-    user = await db.users.find_one({"username": current_user["username"]})
-    if not user:
-        raise HTTPException(404, "Профиль не найден")
+    # Документ уже загружен зависимостью get_current_user
+    user = current_user
 
     return convert_date_fields({
         "avatar_url": user.get("avatar_url"),
@@ -413,6 +687,7 @@ async def update_profile(
 ):
     update_data = {k: v for k, v in data.dict().items() if v is not None}
     await update_user_profile(current_user["username"], update_data)
+    await broker.invalidate_user(current_user["username"])
     return {"message": "Profile updated"}
 
 @app.post("/profile/avatar")
@@ -423,19 +698,9 @@ async def upload_avatar(
     if not file.content_type.startswith("image/"):
         raise HTTPException(400, "Файл должен быть изображением")
 
-    # --- 1) удаляем старый ---
-    user_doc = await db.users.find_one({"username": current_user["username"]})
-    old_id = user_doc.get("avatar_id")
-    if old_id:
-        try:
-            await avatar_fs_bucket.delete(ObjectId(old_id))
-        except:
-            pass
-
-    # --- 2) загружаем новый ---
-    data = await file.read()
-    new_id = await avatar_fs_bucket.upload_from_stream(
-        file.filename, data,
+    # --- 1) загружаем новый ---
+    new_id = await save_upload(
+        avatar_fs_bucket, file,
         metadata={
             "user_id": current_user["username"],
             "content_type": file.content_type,
@@ -443,27 +708,87 @@ async def upload_avatar(
         }
     )
 
-    # --- 3) сохраняем avatar_id в профиле ---
-    await db.users.update_one(
-        {"username": current_user["username"]},
-        {"$set": {"avatar_id": str(new_id)}}
-    )
+    # --- 2) сохраняем avatar_id в профиле ---
+    old_id = await swap_avatar(current_user["username"], str(new_id))
+    # Остальные процессы должны забыть старый avatar_id до удаления файла
+    await broker.invalidate_user(current_user["username"])
+    media_queue.submit(make_avatar_thumbnails, current_user["username"], new_id)
+
+    # --- 3) удаляем старый ---
+    if old_id:
+        try:
+            await delete_upload(avatar_fs_bucket, ObjectId(old_id))
+            await delete_thumbnails(ObjectId(old_id))
+        except:
+            pass
 
     return {"message": "Аватар загружен", "avatar_url": "/profile/avatar"}
 
+def avatar_file_id(user: dict, size: Optional[int] = None) -> Optional[str]:
+    # Наименьшая готовая миниатюра не меньше size; пока их нет — исходный файл
+    thumbnails = user.get("avatar_thumbnails") or {}
+    if size is not None:
+        for thumb_size in AVATAR_THUMB_SIZES:
+            if thumb_size >= size and str(thumb_size) in thumbnails:
+                return thumbnails[str(thumb_size)]
+    return user.get("avatar_id")
+
 @app.get("/profile/avatar")
-async def get_avatar(current_user: dict = Depends(get_current_user)):
-    user_doc = await db.users.find_one({"username": current_user["username"]})
-    avatar_id = user_doc.get("avatar_id")
+async def get_avatar(
+    request: Request,
+    size: Optional[int] = Query(None, ge=1),
+    current_user: dict = Depends(get_current_user)
+):
+    avatar_id = avatar_file_id(current_user, size)
     if not avatar_id:
         raise HTTPException(404, "Аватар не найден")
 
-    try:
-        stream = await avatar_fs_bucket.open_download_stream(ObjectId(avatar_id))
-    except:
+    # URL не содержит id, поэтому браузер должен перепроверять ETag при каждом показе
+    return await gridfs_response(avatar_fs_bucket, avatar_id, request, cache_control="private, no-cache")
+
+AVATAR_BATCH_MAX = 500
+
+def avatar_url(username: str, avatar_id: str, size: Optional[int] = None) -> str:
+    query = f"v={avatar_id}" if size is None else f"size={size}&v={avatar_id}"
+    return f"/avatar/{quote(username)}?{query}"
+
+@app.get("/avatar/{username}")
+async def get_user_avatar(
+    username: str,
+    request: Request,
+    size: Optional[int] = Query(None, ge=1),
+    v: Optional[str] = None,
+):
+    # Запись берётся из кэша аватаров, повторный показ с тем же ETag базу не трогает.
+    # Нет пользователя или нет аватара — одинаковый 404.
+    user = (await get_avatar_records([username])).get(username)
+    avatar_id = avatar_file_id(user, size) if user else None
+    if not avatar_id:
         raise HTTPException(404, "Аватар не найден")
 
-    return StreamingResponse(stream, media_type=stream.metadata.get("content_type"))
+    # v — id файла из POST /avatars: пока он совпадает, содержимое по этому URL
+    # не меняется и его можно кэшировать навсегда; без v — перепроверка ETag
+    cache_control = IMMUTABLE_CACHE_CONTROL if v == avatar_id else "private, no-cache"
+    return await gridfs_response(avatar_fs_bucket, avatar_id, request, cache_control=cache_control)
+
+@app.post("/avatars", response_model=AvatarBatchResponse)
+async def get_avatars(body: AvatarBatchRequest, current_user: dict = Depends(get_current_user)):
+    # Аватары для списка контактов или участников группы за один запрос
+    usernames = list(dict.fromkeys(body.usernames))
+    if len(usernames) > AVATAR_BATCH_MAX:
+        raise HTTPException(400, detail=f"Не больше {AVATAR_BATCH_MAX} пользователей за запрос")
+
+    records = await get_avatar_records(usernames)
+    avatars = {}
+    for username in usernames:
+        user = records.get(username)
+        avatar_id = avatar_file_id(user, body.size) if user else None
+        avatars[username] = {
+            "avatar_id": avatar_id,
+            "etag": make_etag(avatar_id),
+            "url": avatar_url(username, avatar_id, body.size),
+        } if avatar_id else None
+    return json_response({"avatars": avatars})
 
 ### ЗАДАЧИ ###
 
@@ -475,7 +800,7 @@ async def add_task(task: TaskCreate, current_user: dict = Depends(get_current_us
 @app.get("/tasks", response_model=List[TaskOut])
 async def get_tasks(current_user: dict = Depends(get_current_user)):
     tasks = await get_tasks_by_user(current_user["username"])
-    return tasks
+    return json_response(tasks)
 
 @app.delete("/task/{task_id}", response_model=dict)
 async def remove_task(task_id: str, current_user: dict = Depends(get_current_user)):
@@ -501,6 +826,7 @@ async def join_group_endpoint(
 ):
     username = request.username or current_user["username"]
     group = await add_user_to_group(request.invite_key, username, current_user["username"])
+    await broker.invalidate_group(str(group["_id"]))
     return {"message": f"{username} added to group {group['name']}"}
 
 @app.delete("/group/{group_id}")
@@ -512,14 +838,16 @@ async def delete_group_endpoint(
     group = await get_group_by_id(group_id)
     if not group:
         raise HTTPException(status_code=404, detail="Группа не найдена")
-    if group["creator"] != current_user["username"]:
+    if group["admin"] != current_user["username"]:
         raise HTTPException(status_code=403, detail="Только создатель может удалить группу")
 
     # Удаляем группу
     await db.groups.delete_one({"_id": ObjectId(group_id)})
+    await broker.invalidate_group(group_id)
 
     # Удаляем все сообщения, связанные с этой группой
     delete_result = await db.group_messages.delete_many({"group_id": group_id})
+    await delete_search_scope(search_scope(group_id=group_id))
 
     return {
         "message": "Group and related messages deleted successfully",
@@ -529,60 +857,133 @@ async def delete_group_endpoint(
 @app.get("/groups", response_model=List[GroupInfo])
 async def list_user_groups(current_user: dict = Depends(get_current_user)):
     groups = await get_groups_for_user(current_user["username"])
-    return groups
+    return json_response(groups)
 
 @app.get("/group/messages", response_model=List[MessageOut])
 async def get_group_messages(
     group_id: str = Query(...),
     current_user: dict = Depends(get_current_user)
 ):
-    # Проверка существования группы
-    group = await get_group_by_id(group_id)
-    if not group:
-        raise HTTPException(404, detail="Группа не найдена")
-
-    # Проверка членства пользователя
-    if current_user["username"] not in group["members"]:
-        raise HTTPException(403, detail="Вы не состоите в этой группе")
+    # Проверка существования группы и членства пользователя
+    await require_group_member(group_id, current_user["username"])
 
     # Получаем все сообщения этой группы
-    cursor = db.group_messages.find({"group_id": group_id}).sort("timestamp", 1)
-
-    messages = []
-    async for msg in cursor:
-        audio_url = None
-        file_url = None
-        filename = None
-        file_id = msg.get("file_id")
+    cursor = db.group_messages.find({"group_id": group_id}, MESSAGE_FIELDS).sort("timestamp", 1)
+    raw_msgs = await cursor.to_list(length=None)
+    return json_response(await messages_out(raw_msgs))
+
+### ПОИСК ###
+
+@app.get("/search", response_model=List[MessageOut])
+async def search(
+    q: str = Query(..., min_length=1),
+    peer: Optional[str] = Query(None),
+    group_id: Optional[str] = Query(None),
+    before: Optional[str] = Query(None),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+    current_user: dict = Depends(get_current_user)
+):
+    # Поиск в одном диалоге (peer) или одной группе (group_id), от новых к старым
+    if bool(peer) == bool(group_id):
+        raise HTTPException(400, detail="Нужно указать либо peer, либо group_id")
+    if group_id:
+        await require_group_member(group_id, current_user["username"])
+
+    scope = search_scope(current_user["username"], peer, group_id)
+    raw_msgs = await search_messages(scope, q, before=before, limit=limit)
+    return json_response(await messages_out(raw_msgs))
+
+### СИНХРОНИЗАЦИЯ ###
+
+def sync_events(raw_msgs: list, shaped: list) -> list:
+    events = [
+        {"type": "group_message" if "group_id" in raw else "message", "message": message}
+        for raw, message in zip(raw_msgs, shaped)
+    ]
+    events.sort(key=lambda e: (e["message"]["timestamp"], e["message"]["id"]))
+    return events
+
+async def sync_for_user(username: str, since: Optional[str], limit: int, device: Optional[str] = None) -> dict:
+    # Без since продолжаем с сохранённой отметки устройства
+    if since is None:
+        if not device:
+            raise HTTPException(400, detail="Передайте since или device")
+        since = await get_sync_cursor(username, device)
+    personal, group, overlap = await get_events_since(username, since, limit)
+    shaped = await messages_out(overlap + personal + group)
+
+    events = sync_events(personal + group, shaped[len(overlap):])
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    cursor = events[-1]["message"]["cursor"] if events else since
+    if events and device:
+        await advance_sync_cursor(username, device, cursor)
+    # Перечитанное окно до курсора — впереди: клиент пропускает известные id
+    events = sync_events(overlap, shaped[:len(overlap)]) + events
+    return {"events": events, "cursor": cursor, "has_more": has_more}
+
+@app.get("/sync", response_model=SyncResponse)
+async def sync(
+    since: Optional[str] = Query(None),
+    device: Optional[str] = Query(None, max_length=64),
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_PAGE_MAX),
+    current_user: dict = Depends(get_current_user)
+):
+    # device — постоянный идентификатор установки клиента; без since продолжаем
+    # с сохранённой на сервере отметки последней доставки на это устройство
+    return json_response(await sync_for_user(current_user["username"], since, limit, device))
 
-        if msg.get("audio_file_id"):
-            audio_url = f"/voice/{msg['audio_file_id']}"
+### WEBRTC ЗВОНКИ ###
 
-        if file_id:
-            file_url = f"/file/{file_id}"
-            try:
-                file_doc = await db.fs.files.find_one({"_id": ObjectId(file_id)})
-                if file_doc:
-                    filename = file_doc["filename"]
-            except:
-                pass
-
-        messages.append(MessageOut(
-            sender=msg["sender"],
-            receiver=group_id,  # в этом случае "receiver" — это id группы
-            content=decrypt_message(msg["content"]) if msg.get("content") else None,
-            audio_url=audio_url,
-            file_id=str(file_id) if file_id else None,
-            file_url=file_url,
-            filename=filename,
-            timestamp=msg["timestamp"]
-        ))
-
-    return messages
+# Типизированный протокол отправки по уже открытому сокету:
+#   -> {"type": "send_message", "receiver": ..., "content": ..., "client_id": ...}
+#   -> {"type": "send_group_message", "group_id": ..., "content": ..., "client_id": ...}
+#   <- {"type": "ack", "client_id": ..., "id": ..., "timestamp": ...}
+#   <- {"type": "error", "client_id": ..., "detail": ...}
+# Кадры без type ({"to", "data"}) по-прежнему пересылаются как WebRTC-сигналинг.
+WS_SEND_HANDLERS = {
+    "send_message": lambda username, msg: send_personal_text(
+        username, msg["receiver"], msg["content"], msg.get("client_id")
+    ),
+    "send_group_message": lambda username, msg: send_group_text(
+        username, msg["group_id"], msg["content"], msg.get("client_id")
+    ),
+}
+
+async def handle_ws_send(conn: Connection, msg: dict):
+    client_id = msg.get("client_id")
+    try:
+        doc = await WS_SEND_HANDLERS[msg["type"]](conn.username, msg)
+    except HTTPException as e:
+        conn.enqueue(json.dumps({"type": "error", "client_id": client_id, "detail": e.detail}))
+        return
+    except (KeyError, TypeError, AttributeError, InvalidId):
+        conn.enqueue(json.dumps({"type": "error", "client_id": client_id, "detail": "Неверный формат сообщения"}))
+        return
 
-### WEBRTC ЗВОНКИ ###
+    conn.enqueue(json.dumps({
+        "type": "ack",
+        "client_id": client_id,
+        "id": str(doc["_id"]),
+        "timestamp": doc["timestamp"].isoformat()
+    }))
 
-active_connections_ws: Dict[str, WebSocket] = {}
+async def handle_ws_sync(conn: Connection, msg: dict):
+    # -> {"type": "sync", "since": ..., "device": ..., "limit": ...}  <- {"type": "sync", "events": [...], "cursor": ..., "has_more": ...}
+    try:
+        limit = max(1, min(int(msg.get("limit") or MESSAGES_PAGE_SIZE), MESSAGES_PAGE_MAX))
+        device = msg.get("device")
+        if device is not None and (not isinstance(device, str) or len(device) > 64):
+            raise ValueError(device)
+        result = await sync_for_user(conn.username, msg.get("since"), limit, device)
+    except HTTPException as e:
+        conn.enqueue(json.dumps({"type": "error", "detail": e.detail}))
+        return
+    except (TypeError, ValueError):
+        conn.enqueue(json.dumps({"type": "error", "detail": "Неверный формат сообщения"}))
+        return
+    conn.enqueue(to_json({"type": "sync", **result}).decode())
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -593,7 +994,7 @@ async def websocket_endpoint(websocket: WebSocket):
 
     username = current_user["username"]
     await websocket.accept()
-    active_connections_ws[username] = websocket
+    conn = add_connection(username, websocket)
     print(f"🔗 {username} подключился")
 
     try:
@@ -601,6 +1002,14 @@ async def websocket_endpoint(websocket: WebSocket):
             try:
                 raw = await websocket.receive_text()
                 msg = json.loads(raw)
+
+                if msg.get("type") in WS_SEND_HANDLERS:
+                    await handle_ws_send(conn, msg)
+                    continue
+                if msg.get("type") == "sync":
+                    await handle_ws_sync(conn, msg)
+                    continue
+
                 to_user = msg.get("to")
                 payload = msg.get("data")
 
@@ -608,18 +1017,16 @@ async def websocket_endpoint(websocket: WebSocket):
                     print(f"⚠️ Пустой to или data от {username}: {msg}")
                     continue
 
-                if to_user in active_connections_ws:
-                    print(f"➡️ Пересылка от {username} к {to_user}")
-                    await active_connections_ws[to_user].send_text(json.dumps({
-                        "from": username,
-                        "data": payload
-                    }))
-                else:
-                    print(f"❌ {to_user} не в сети")
+                # Получатель может быть подключён к другому процессу — идём через брокер
+                print(f"➡️ Пересылка от {username} к {to_user}")
+                await broker.publish([to_user], json.dumps({
+                    "from": username,
+                    "data": payload
+                }))
             except Exception as e:
                 print(f"💥 Ошибка при обработке сообщения от {username}: {e}")
                 break  # выходим из while
     except WebSocketDisconnect:
         print(f"🔌 {username} отключился")
     finally:
-        active_connections_ws.pop(username, None)
\ No newline at end of file
+        conn.close()
\ No newline at end of file
@@ -0,0 +1,185 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from bson import Binary, ObjectId
+from models import db, voice_fs_bucket, avatar_fs_bucket, set_avatar_thumbnails
+from broker import broker
+import asyncio
+import shutil
+import sys
+import wave
+
+# Pillow необязателен: без него аватары отдаются только в исходном размере
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Фоновая обработка медиа после загрузки: миниатюры аватаров и длительность/
+# волна голосовых. Очередь живёт в памяти процесса — задачи, не успевшие
+# выполниться до перезапуска, теряются, и файл просто остаётся без метаданных.
+MEDIA_WORKERS = 2
+MEDIA_QUEUE_SIZE = 1000
+AVATAR_THUMB_SIZES = (64, 128)
+WAVEFORM_POINTS = 64  # столбиков в волне голосового
+WAVEFORM_SAMPLE_RATE = 8000  # для волны и длительности хватает 8 кГц моно
+
+# ffmpeg декодирует любые форматы браузерного MediaRecorder (webm/opus, ogg, mp4);
+# без него разбираются только WAV
+FFMPEG = shutil.which("ffmpeg")
+
+media_stats = {
+    "queued": 0,
+    "done": 0,
+    "failed": 0,
+    "dropped": 0,
+}
+
+# Декодирование и ресайз занимают CPU — выполняем их вне event loop
+_media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+
+class MediaQueue:
+    """Очередь фоновых задач с пулом воркеров-корутин."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue: asyncio.Queue = None
+        self.tasks = []
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=MEDIA_QUEUE_SIZE)
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    def submit(self, func, *args):
+        # Не ждём: загрузка отвечает клиенту сразу, метаданные появятся позже
+        try:
+            self.queue.put_nowait((func, args))
+            media_stats["queued"] += 1
+        except asyncio.QueueFull:
+            media_stats["dropped"] += 1
+
+    async def _work(self):
+        while True:
+            func, args = await self.queue.get()
+            try:
+                await func(*args)
+                media_stats["done"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                media_stats["failed"] += 1
+                print(f"💥 Ошибка обработки медиа {func.__name__}: {e}")
+
+media_queue = MediaQueue(MEDIA_WORKERS)
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_media_executor, func, *args)
+
+### АВАТАРЫ ###
+
+def render_thumbnails(data: bytes) -> dict:
+    # size -> WebP квадратной миниатюры
+    image = Image.open(BytesIO(data))
+    image = ImageOps.exif_transpose(image).convert("RGBA")
+    thumbnails = {}
+    for size in AVATAR_THUMB_SIZES:
+        thumb = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        out = BytesIO()
+        thumb.save(out, "WEBP", quality=80)
+        thumbnails[size] = out.getvalue()
+    return thumbnails
+
+async def make_avatar_thumbnails(username: str, avatar_id: ObjectId):
+    if Image is None:
+        return
+    grid_out = await avatar_fs_bucket.open_download_stream(avatar_id)
+    thumbnails = await _run(render_thumbnails, await grid_out.read())
+
+    ids = {}
+    for size, blob in thumbnails.items():
+        # Без user_id: миниатюры служебные и в квоту пользователя не входят
+        thumb_id = await avatar_fs_bucket.upload_from_stream(
+            f"{avatar_id}_{size}.webp", blob,
+            metadata={"content_type": "image/webp", "thumbnail_of": avatar_id, "size": size}
+        )
+        ids[str(size)] = str(thumb_id)
+
+    if not await set_avatar_thumbnails(username, str(avatar_id), ids):
+        # Пока считали, пользователь сменил аватар
+        await delete_thumbnails(avatar_id)
+        return
+    await broker.invalidate_user(username)
+
+async def delete_thumbnails(avatar_id: ObjectId):
+    async for doc in db.avatars.files.find({"metadata.thumbnail_of": avatar_id}, {"_id": 1}):
+        await avatar_fs_bucket.delete(doc["_id"])
+
+### ГОЛОСОВЫЕ ###
+
+async def decode_pcm(data: bytes):
+    """Декодирует аудио в 16-битный PCM. Возвращает (pcm, частота, каналы) или None."""
+    if FFMPEG:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG, "-v", "error", "-i", "pipe:0",
+            "-f", "s16le", "-ac", "1", "-ar", str(WAVEFORM_SAMPLE_RATE), "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        pcm, _ = await process.communicate(data)
+        if process.returncode != 0:
+            return None
+        return pcm, WAVEFORM_SAMPLE_RATE, 1
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return await _run(read_wav, data)
+    return None
+
+def read_wav(data: bytes):
+    with wave.open(BytesIO(data)) as wav:
+        if wav.getsampwidth() != 2:
+            return None
+        return wav.readframes(wav.getnframes()), wav.getframerate(), wav.getnchannels()
+
+def waveform(pcm: bytes, rate: int, channels: int):
+    # Длительность в секундах и WAVEFORM_POINTS пиков амплитуды в диапазоне 0..255
+    samples = array("h")
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    duration = len(samples) / channels / rate
+    if not samples:
+        return duration, bytes(WAVEFORM_POINTS)
+    # Границы окон i*n//WAVEFORM_POINTS: точек всегда ровно WAVEFORM_POINTS,
+    # у записей короче WAVEFORM_POINTS сэмплов пустые окна дают 0
+    n = len(samples)
+    peaks = []
+    for i in range(WAVEFORM_POINTS):
+        window = samples[i * n // WAVEFORM_POINTS:(i + 1) * n // WAVEFORM_POINTS]
+        peaks.append(min(max(max(window), -min(window)) * 255 // 32767, 255) if window else 0)
+    return duration, bytes(peaks)
+
+async def analyze_voice(file_id: ObjectId, collection: str, message_id: ObjectId):
+    grid_out = await voice_fs_bucket.open_download_stream(file_id)
+    decoded = await decode_pcm(await grid_out.read())
+    if decoded is None:
+        return
+    duration, peaks = await _run(waveform, *decoded)
+    duration = round(duration, 2)
+    waveform_bin = Binary(peaks)
+
+    # Рядом с файлом — для будущих выборок по voice_fs; в сообщении — чтобы
+    # листинг истории отдавал волну без лишнего запроса
+    await db.voice_fs.files.update_one(
+        {"_id": file_id},
+        {"$set": {"metadata.duration": duration, "metadata.waveform": waveform_bin}}
+    )
+    await db[collection].update_one(
+        {"_id": message_id},
+        {"$set": {"voice": {"duration": duration, "waveform": waveform_bin}}}
+    )
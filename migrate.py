@@ -0,0 +1,24 @@
+# Разовая миграция базы после обновления:
+#   python migrate.py
+# Убирает дубли, мешающие уникальным индексам, и создаёт эти индексы.
+# Переводит ключи диалогов (conversation_id) на однозначный формат (это же
+# сервер делает сам при старте в фоне, под арендой в db.locks).
+# Переносит отметки синхронизации на устройства (индекс sync_state).
+# Перепаковывает старые base64-шифртексты в бинарный формат (см. crypto.py).
+# Сервер читает оба формата, поэтому миграцию можно запускать на живой базе.
+import asyncio
+from models import db, dedupe_unique_fields, ensure_indexes, migrate_conversation_ids, migrate_sync_state, migrate_ciphertext_to_binary
+
+async def main():
+    report = await dedupe_unique_fields()
+    print(f"дубли: {report}")
+    await migrate_sync_state()
+    await ensure_indexes()
+    print(f"messages: обновлено ключей диалогов {await migrate_conversation_ids()}")
+
+    for collection in (db.messages, db.group_messages):
+        migrated = await migrate_ciphertext_to_binary(collection)
+        print(f"{collection.name}: перепаковано {migrated}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
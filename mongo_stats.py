@@ -0,0 +1,45 @@
+from contextvars import ContextVar
+from pymongo import monitoring
+import bson
+import os
+
+# Учёт байт, полученных из MongoDB, в разрезе HTTP-запросов.
+# Включается REDFAX_MONGO_STATS=1: перекодирование ответов в BSON ради подсчёта
+# размера стоит CPU, поэтому в обычном режиме слушатель не регистрируется.
+MONGO_STATS_ENABLED = os.getenv("REDFAX_MONGO_STATS") == "1"
+
+# Счётчики текущего запроса. Motor копирует контекст в поток исполнителя,
+# поэтому слушатель видит тот же словарь, что и middleware.
+request_mongo_stats: ContextVar = ContextVar("request_mongo_stats", default=None)
+
+# Отчёт: маршрут -> {"requests", "commands", "bytes"}
+mongo_stats_by_route: dict = {}
+
+class MongoBytesListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        stats = request_mongo_stats.get()
+        if stats is not None:
+            stats["commands"] += 1
+            stats["bytes"] += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+def mongo_event_listeners() -> list:
+    return [MongoBytesListener()] if MONGO_STATS_ENABLED else []
+
+def record_request(route: str, stats: dict):
+    report = mongo_stats_by_route.setdefault(route, {"requests": 0, "commands": 0, "bytes": 0})
+    report["requests"] += 1
+    report["commands"] += stats["commands"]
+    report["bytes"] += stats["bytes"]
+
+def mongo_stats_report() -> dict:
+    # Средний объём на запрос — основная метрика для сравнения проекций
+    return {
+        route: {**report, "bytes_per_request": report["bytes"] // report["requests"]}
+        for route, report in mongo_stats_by_route.items()
+    }
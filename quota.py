@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta
+from typing import Optional
+from fastapi import HTTPException
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from models import db, fs_bucket, voice_fs_bucket, avatar_fs_bucket
+import asyncio
+
+# Учёт занятого места: один документ на пользователя
+#   usage — {_id: username, files: n, bytes: n, counts: {fs: n, voice_fs: n, avatars: n}, updated_at}
+# Меняется атомарным $inc при каждой загрузке и удалении, поэтому проверка
+# квоты — одно обновление по _id вместо count_documents по fs.files.
+# Лимит количества касается обычных файлов (fs), лимит объёма — всех бакетов.
+QUOTA_MAX_FILES = 20
+QUOTA_MAX_BYTES = 1024 * 1024 * 1024  # 1 ГБ на пользователя
+QUOTA_RECONCILE_INTERVAL = 6 * 3600  # секунд между сверками с fs.files
+# Счётчики, менявшиеся позже (started - QUOTA_RECONCILE_GRACE), сверка не трогает:
+# загрузка списывает место до записи файла, и агрегация могла его ещё не увидеть
+QUOTA_RECONCILE_GRACE = timedelta(minutes=10)
+
+usage_collection = db.usage
+
+# имя бакета -> бакет; имя совпадает с префиксом коллекций GridFS
+QUOTA_BUCKETS = {
+    "fs": fs_bucket,
+    "voice_fs": voice_fs_bucket,
+    "avatars": avatar_fs_bucket,
+}
+
+def bucket_name(bucket) -> str:
+    for name, candidate in QUOTA_BUCKETS.items():
+        if candidate is bucket:
+            return name
+    raise ValueError("Неизвестный бакет")
+
+def quota_exceeded() -> HTTPException:
+    return HTTPException(
+        400,
+        detail=f"Превышена квота: не больше {QUOTA_MAX_FILES} файлов и {QUOTA_MAX_BYTES // 2**20} МБ"
+    )
+
+async def check_usage(user_id: str, bucket: str, size: Optional[int], files: int = 1):
+    """Предварительная проверка квоты до приёма тела загрузки; при превышении бросает 400.
+
+    size — известный заранее размер (UploadFile.size); None — неизвестен,
+    тогда нужен хотя бы байт. Окончательно решает charge_usage: между
+    проверкой и списанием место могут занять.
+    """
+    doc = await usage_collection.find_one({"_id": user_id}, {"bytes": 1, "counts": 1}) or {}
+    if doc.get("bytes", 0) + (1 if size is None else size) > QUOTA_MAX_BYTES:
+        raise quota_exceeded()
+    if bucket == "fs" and doc.get("counts", {}).get("fs", 0) + files > QUOTA_MAX_FILES:
+        raise quota_exceeded()
+
+async def charge_usage(user_id: str, bucket: str, size: int, files: int = 1):
+    """Списывает место под файл; при превышении квоты бросает 400.
+
+    Условие и увеличение счётчиков выполняются одним update_one, поэтому
+    параллельные загрузки не могут вместе пробить лимит.
+    """
+    over_limit = quota_exceeded()
+    # Для ещё не созданного документа условие ниже не проверяется — upsert его вставит
+    if size > QUOTA_MAX_BYTES or (bucket == "fs" and files > QUOTA_MAX_FILES):
+        raise over_limit
+    query = {"_id": user_id}
+    if size > 0:
+        query["bytes"] = {"$lte": QUOTA_MAX_BYTES - size}
+    if files > 0 and bucket == "fs":
+        query["counts.fs"] = {"$lte": QUOTA_MAX_FILES - files}
+    update = {
+        "$inc": {"files": files, "bytes": size, f"counts.{bucket}": files},
+        "$set": {"updated_at": datetime.utcnow()},
+    }
+    try:
+        # Если документа ещё нет, upsert создаёт его; если он есть, но условие
+        # не выполнилось, upsert упирается в _id
+        await usage_collection.update_one(query, update, upsert=True)
+    except DuplicateKeyError:
+        # Либо квота исчерпана, либо документ только что создал параллельный запрос
+        result = await usage_collection.update_one(query, update)
+        if result.matched_count == 0:
+            raise over_limit
+
+async def release_usage(user_id: str, bucket: str, size: int, files: int = 1):
+    await usage_collection.update_one(
+        {"_id": user_id},
+        {
+            "$inc": {"files": -files, "bytes": -size, f"counts.{bucket}": -files},
+            "$set": {"updated_at": datetime.utcnow()},
+        }
+    )
+
+async def get_usage(user_id: str) -> dict:
+    doc = await usage_collection.find_one({"_id": user_id}) or {}
+    return {
+        "files": doc.get("counts", {}).get("fs", 0),
+        "bytes": doc.get("bytes", 0),
+        "max_files": QUOTA_MAX_FILES,
+        "max_bytes": QUOTA_MAX_BYTES,
+    }
+
+async def reconcile_usage():
+    """Пересчитывает счётчики по файлам во всех бакетах.
+
+    Исправляет расхождения после сбоев между записью файла и $inc. Документы
+    пользователей, чьи счётчики менялись во время сверки или незадолго до неё,
+    не перезаписываются и не удаляются — их сверит следующий проход.
+    """
+    started = datetime.utcnow()
+    idle = {"$or": [
+        {"updated_at": {"$lt": started - QUOTA_RECONCILE_GRACE}},
+        {"updated_at": {"$exists": False}},
+    ]}
+    totals = {}
+    for name in QUOTA_BUCKETS:
+        pipeline = [
+            {"$group": {"_id": "$metadata.user_id", "files": {"$sum": 1}, "bytes": {"$sum": "$length"}}},
+        ]
+        async for row in db[f"{name}.files"].aggregate(pipeline):
+            if row["_id"] is None:
+                continue
+            usage = totals.setdefault(row["_id"], {"files": 0, "bytes": 0, "counts": {}})
+            usage["files"] += row["files"]
+            usage["bytes"] += row["bytes"]
+            usage["counts"][name] = row["files"]
+
+    ops = [
+        ReplaceOne({"_id": user_id, **idle}, {**usage, "reconciled_at": started}, upsert=True)
+        for user_id, usage in totals.items()
+    ]
+    if ops:
+        try:
+            await usage_collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # 11000 — документ есть, но недавно менялся: upsert упёрся в _id
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+    # Не попавшие в сверку документы принадлежат пользователям без файлов
+    await usage_collection.delete_many({"reconciled_at": {"$not": {"$gte": started}}, **idle})
+
+async def claim_reconcile() -> bool:
+    """Аренда сверки на QUOTA_RECONCILE_INTERVAL: из всех воркеров проход делает один."""
+    now = datetime.utcnow()
+    try:
+        await db.locks.update_one(
+            {"_id": "reconcile_usage", "until": {"$lt": now}},
+            {"$set": {"until": now + timedelta(seconds=QUOTA_RECONCILE_INTERVAL)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def reconcile_usage_forever():
+    # Первый проход сразу: после обновления документов usage ещё нет
+    while True:
+        try:
+            if await claim_reconcile():
+                await reconcile_usage()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"💥 Ошибка сверки квот: {e}")
+        await asyncio.sleep(QUOTA_RECONCILE_INTERVAL)
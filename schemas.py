@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime, date
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 class UserLogin(BaseModel):
     username: str
@@ -38,6 +38,15 @@ class FileCreate(BaseModel):
 class FileUpdate(BaseModel):
     content: str
 
+class TextPatch(BaseModel):
+    offset: int  # в байтах UTF-8 от начала документа, на границе символа
+    length: int = 0  # сколько байт заменить; конец тоже на границе символа
+    replacement: str = ""
+
+class TextPatchRequest(BaseModel):
+    base_version: int  # версия, с которой клиент начинал правку
+    patches: List[TextPatch]  # применяются по порядку, каждая к результату предыдущей
+
 class UserProfile(BaseModel):
     avatar_url: Optional[str] = None
     birth_date: Optional[str] = None  # Храним как строку (ISO)
@@ -51,6 +60,18 @@ class UserProfile(BaseModel):
 class UserProfileUpdate(UserProfile):
     pass
 
+class AvatarBatchRequest(BaseModel):
+    usernames: List[str]
+    size: Optional[int] = None  # желаемый размер миниатюры в пикселях
+
+class AvatarInfo(BaseModel):
+    avatar_id: str
+    etag: str
+    url: str
+
+class AvatarBatchResponse(BaseModel):
+    avatars: Dict[str, Optional[AvatarInfo]]  # None — аватара нет
+
 class TaskCreate(BaseModel):
     title: str
     date: date  # формат YYYY-MM-DD
@@ -77,7 +98,7 @@ class GroupInfo(BaseModel):
     name: str
     admin: str
     invite_key: str
-    members: List[str]
+    member_count: int
 
 class GroupMessageCreate(BaseModel):
     group_id: str
@@ -94,10 +115,14 @@ class MessageCreate(BaseModel):
     audio_file_id: Optional[str] = None
 
 class MessageOut(BaseModel):
+    id: Optional[str] = None
+    cursor: Optional[str] = None  # передаётся в before/after для следующей страницы
     sender: str
     receiver: Optional[str]
     content: Optional[str]
     audio_url: Optional[str]
+    audio_duration: Optional[float] = None  # секунды; появляется после фоновой обработки
+    audio_waveform: Optional[List[int]] = None  # пики амплитуды 0..255
     file_id: Optional[str] = None
     file_url: Optional[str] = None
     filename: Optional[str] = None
@@ -111,4 +136,14 @@ class MessageInput(BaseModel):
 class MessagePayload(BaseModel):
     receiver: str | None = None
     group_id: str | None = None
-    content: str
\ No newline at end of file
+    content: str
+    client_id: str | None = None  # ключ идемпотентности, генерирует клиент
+
+class SyncEvent(BaseModel):
+    type: str  # "message" | "group_message"
+    message: MessageOut
+
+class SyncResponse(BaseModel):
+    events: List[SyncEvent]
+    cursor: Optional[str] = None  # передать в since при следующей синхронизации
+    has_more: bool
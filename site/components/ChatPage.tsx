@@ -1,6 +1,6 @@
 import React, { useState, useCallback, useEffect, useRef } from 'react';
 import type { Message, Contact, ApiMessage, Group } from '../types';
-import { api } from '../services/apiService';
+import { api, MESSAGES_PAGE_SIZE } from '../services/apiService';
 import { useWebSocket } from '../hooks/useWebSocket';
 import ContactList from './ContactList';
 import ChatWindow from './ChatWindow';
@@ -29,11 +29,28 @@ type CallState = 'idle' | 'initiating' | 'receiving' | 'connected';
 
 const configuration = { iceServers: [{ urls: 'stun:stun.l.google.com:19302' }] };
 
+const toMessage = (msg: ApiMessage, username: string): Message => ({
+  id: msg.id || `${msg.sender}-${msg.timestamp}`,
+  sender: msg.sender,
+  receiver: msg.receiver,
+  content: msg.content ?? null,
+  audioFileId: msg.audio_url?.split('/').pop() || undefined,
+  file: msg.file_id ? { id: msg.file_id, name: msg.filename || 'Загруженный файл' } : undefined,
+  timestamp: new Date(msg.timestamp).getTime(),
+  isSentByMe: msg.sender === username,
+});
+
+// Страница приходит от новых к старым: продолжать с cursor её последнего элемента
+const nextHistoryCursor = (page: ApiMessage[]): string | null =>
+  page.length === MESSAGES_PAGE_SIZE ? page[page.length - 1].cursor ?? null : null;
+
 const ChatPage: React.FC<ChatPageProps> = ({ user, token, onLogout, onNavigate }) => {
   const [contacts, setContacts] = useState<Contact[]>([]);
   const [groups, setGroups] = useState<Group[]>([]);
   const [activeChat, setActiveChat] = useState<ActiveChat | null>(null);
   const [messages, setMessages] = useState<{ [key: string]: Message[] }>({});
+  // cursor самого старого загруженного сообщения диалога; null — история загружена целиком
+  const [historyCursors, setHistoryCursors] = useState<{ [key: string]: string | null }>({});
   const [isAddContactModalOpen, setIsAddContactModalOpen] = useState(false);
   const [isGroupModalOpen, setIsGroupModalOpen] = useState(false);
   const [isAttachmentModalOpen, setIsAttachmentModalOpen] = useState(false);
@@ -339,22 +356,12 @@ const ChatPage: React.FC<ChatPageProps> = ({ user, token, onLogout, onNavigate }
         if (activeChat.isGroup) {
           chatMessages = await api.getGroupMessages(token, activeChat.id);
         } else {
-          const history: ApiMessage[] = await api.getMessages(token);
-          chatMessages = history.filter(
-            msg => (msg.sender === user.username && msg.receiver === activeChat.id) || (msg.sender === activeChat.id && msg.receiver === user.username)
-          );
+          // Сервер отдаёт последнюю страницу именно этого диалога
+          chatMessages = await api.getMessages(token, activeChat.id);
+          setHistoryCursors(prev => ({ ...prev, [activeChat.id]: nextHistoryCursor(chatMessages) }));
         }
 
-        const processedMessages: Message[] = chatMessages.map((msg): Message => ({
-              id: `${msg.sender}-${msg.timestamp}`,
-              sender: msg.sender,
-              receiver: msg.receiver,
-              content: msg.content ?? null,
-              audioFileId: msg.audio_url?.split('/').pop() || undefined,
-              file: msg.file_id ? { id: msg.file_id, name: msg.filename || 'Загруженный файл' } : undefined,
-              timestamp: new Date(msg.timestamp).getTime(),
-              isSentByMe: msg.sender === user.username,
-            }))
+        const processedMessages: Message[] = chatMessages.map(msg => toMessage(msg, user.username))
             .sort((a, b) => a.timestamp - b.timestamp);
           
         setMessages(prev => ({
@@ -373,6 +380,25 @@ const ChatPage: React.FC<ChatPageProps> = ({ user, token, onLogout, onNavigate }
     fetchMessageHistory();
   }, [activeChat, token, user.username, onLogout]);
 
+  const loadOlderMessages = async () => {
+    if (!activeChat || activeChat.isGroup || !token) return;
+    const chatId = activeChat.id;
+    const before = historyCursors[chatId];
+    if (!before) return;
+    try {
+      const page = await api.getMessages(token, chatId, before);
+      setHistoryCursors(prev => ({ ...prev, [chatId]: nextHistoryCursor(page) }));
+      setMessages(prev => ({
+        ...prev,
+        [chatId]: [...page.map(msg => toMessage(msg, user.username)), ...(prev[chatId] || [])].sort((a, b) => a.timestamp - b.timestamp),
+      }));
+    } catch (err: any) {
+      if (err.message === 'AUTH_FAILURE') onLogout();
+      setError('Не удалось загрузить историю сообщений.');
+      console.error(err);
+    }
+  };
+
 
   const handleSendMessage = async (payload: { content?: string; audioFile?: File }) => {
     if (!activeChat || !token) return;
@@ -544,6 +570,8 @@ const ChatPage: React.FC<ChatPageProps> = ({ user, token, onLogout, onNavigate }
             messages={activeChat ? messages[activeChat.id] || [] : []}
             onSendMessage={handleSendMessage}
             isLoading={isMessagesLoading}
+            hasOlderMessages={!!(activeChat && historyCursors[activeChat.id])}
+            onLoadOlder={loadOlderMessages}
             onDeleteChat={handleDeleteChat}
             error={error}
             onAttachmentClick={() => setIsAttachmentModalOpen(true)}
@@ -9,6 +9,8 @@ interface ChatWindowProps {
   messages: Message[];
   onSendMessage: (payload: { content?: string; audioFile?: File }) => void;
   isLoading: boolean;
+  hasOlderMessages: boolean;
+  onLoadOlder: () => void;
   onDeleteChat: () => void;
   error: string | null;
   onAttachmentClick: () => void;
@@ -79,7 +81,7 @@ const EndCallIcon = () => (
 
 
 const ChatWindow: React.FC<ChatWindowProps> = ({ 
-    activeChatInfo, messages, onSendMessage, isLoading, onDeleteChat, error, onAttachmentClick, onOpenFilePreview,
+    activeChatInfo, messages, onSendMessage, isLoading, hasOlderMessages, onLoadOlder, onDeleteChat, error, onAttachmentClick, onOpenFilePreview,
     callState, remoteStream, callLogs, onStartCall, onEndCall, onAcceptCall, onDeclineCall
 }) => {
   const [inputValue, setInputValue] = useState('');
@@ -103,7 +105,9 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
     callLogEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [callLogs]);
 
-  useEffect(scrollToBottom, [messages]);
+  // Подгрузка старых сообщений добавляет их сверху — прокручиваем вниз только при новом последнем
+  const lastMessageId = messages.length ? messages[messages.length - 1].id : null;
+  useEffect(scrollToBottom, [lastMessageId]);
 
   useEffect(() => {
     if (remoteStream && remoteAudioRef.current) {
@@ -316,9 +320,21 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
                 <p className="text-gray-500">Сообщений пока нет. Начните диалог!</p>
             </div>
         ) : (
-            messages.map(msg => (
-                <MessageBubble key={msg.id} message={msg} isGroup={activeChatInfo.isGroup} onOpenFilePreview={onOpenFilePreview} />
-            ))
+            <>
+                {hasOlderMessages && (
+                    <div className="flex justify-center mb-4">
+                        <button
+                            onClick={onLoadOlder}
+                            className="text-sm text-gray-600 dark:text-gray-400 hover:text-soviet-red px-3 py-1 rounded-md transition-colors duration-200"
+                        >
+                            Загрузить более ранние сообщения
+                        </button>
+                    </div>
+                )}
+                {messages.map(msg => (
+                    <MessageBubble key={msg.id} message={msg} isGroup={activeChatInfo.isGroup} onOpenFilePreview={onOpenFilePreview} />
+                ))}
+            </>
         )}
         <div ref={messagesEndRef} />
       </div>
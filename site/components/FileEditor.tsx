@@ -49,6 +49,8 @@ const FileEditor: React.FC<FileEditorProps> = ({ activeFile, onSave }) => {
   const [isDragging, setIsDragging] = useState(false);
   const [startPos, setStartPos] = useState({ x: 0, y: 0 });
 
+  const isFileLoaded = activeFile?.content !== undefined;
+
   useEffect(() => {
     if (activeFile?.content !== undefined) {
       setContent(activeFile.content);
@@ -60,7 +62,10 @@ const FileEditor: React.FC<FileEditorProps> = ({ activeFile, onSave }) => {
     setZoom(1);
     setTranslate({ x: 0, y: 0 });
     setIsDragging(false);
-  }, [activeFile]);
+    // Only on switching files or loading their content: after a save or a
+    // conflict reload the typed text must stay in the editor
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [activeFile?.id, isFileLoaded]);
 
   const handleSave = async () => {
     if (!activeFile || content === null) return;
@@ -1,7 +1,7 @@
 
 import React, { useState, useCallback, useRef, useEffect } from 'react';
 import type { UserFile } from '../types';
-import { api } from '../services/apiService';
+import { api, textPatch, DOCUMENT_CONFLICT } from '../services/apiService';
 import FileList from './FileList';
 import FileEditor from './FileEditor';
 import AddFileModal from './AddFileModal';
@@ -77,6 +77,7 @@ const FilesPage: React.FC<FilesPageProps> = ({ user, token }) => {
         id: f.file_id,
         name: f.filename,
         contentType: f.content_type,
+        version: f.version,
       }));
       
       setFiles(prevFiles => {
@@ -179,14 +180,38 @@ const FilesPage: React.FC<FilesPageProps> = ({ user, token }) => {
     }
   };
 
+  // Актуальные содержимое и версия документа, изменённого в другом окне
+  const reloadDocument = async (fileId: string) => {
+    const [apiFiles, blob] = await Promise.all([
+      api.getFiles(token, user.username),
+      api.getFileBlob(token, fileId),
+    ]);
+    const version = apiFiles.find(f => f.file_id === fileId)?.version;
+    const text = await blob.text();
+    setFiles(current => current.map(f => (f.id === fileId ? { ...f, content: text, version } : f)));
+  };
+
   const handleSaveFile = async (fileId: string, content: string, filename: string) => {
     setError(null);
+    const file = files.find(f => f.id === fileId);
     try {
-        const { new_file_id } = await api.updateTextFile(token, user.username, fileId, content, filename);
-        // To ensure the UI is in sync, fetch all files again and set the new one as active.
-        await fetchFiles();
+        if (file?.version !== undefined && file.content !== undefined) {
+            // Документ: отправляем только изменённый фрагмент, а не весь текст
+            const patch = textPatch(file.content, content);
+            const { version } = await api.patchTextFile(token, user.username, fileId, file.version, patch ? [patch] : []);
+            setFiles(current => current.map(f => (f.id === fileId ? { ...f, content, version } : f)));
+            return;
+        }
+        // Старый файл без версии: полная загрузка превращает его в документ
+        const { new_file_id, version } = await api.updateTextFile(token, user.username, fileId, content, filename);
+        setFiles(current => current.map(f => (f.id === fileId ? { ...f, id: new_file_id, content, version } : f)));
         setActiveFileId(new_file_id);
     } catch (err: any) {
+        if (err instanceof Error && err.message === DOCUMENT_CONFLICT) {
+            // Редактор сохраняет набранный текст; следующее сохранение запишет его поверх новой версии
+            await reloadDocument(fileId);
+            throw new Error('Документ изменился на сервере. Сохраните ещё раз, чтобы записать вашу версию поверх.');
+        }
         const errorMessage = err instanceof Error ? err.message : "Не удалось сохранить файл.";
         setError(errorMessage);
         console.error("Failed to save file:", err);
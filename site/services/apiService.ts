@@ -1,6 +1,7 @@
-import type { Contact, ApiMessage, ApiFile, ApiProfile, CalendarEvent, ApiGroup, Group } from '../types';
+import type { Contact, ApiMessage, ApiFile, ApiProfile, CalendarEvent, ApiGroup, Group, TextPatch } from '../types';
 
 const API_URL = 'https://redfax-server.loca.lt';
+export const MESSAGES_PAGE_SIZE = 50;
 
 const handleNetworkError = (error: unknown): never => {
     if (error instanceof TypeError && error.message === 'Failed to fetch') {
@@ -28,6 +29,40 @@ const handleResponseError = async (response: Response, defaultError: string): Pr
     throw new Error(errorMessage);
 };
 
+// Сервер отвечает 409, если документ успели изменить с версии base_version
+export const DOCUMENT_CONFLICT = 'DOCUMENT_CONFLICT';
+
+const utf8Length = (text: string): number => new TextEncoder().encode(text).length;
+
+const isHighSurrogate = (code: number) => code >= 0xd800 && code <= 0xdbff;
+
+/**
+ * Одна правка, превращающая before в after: общий префикс и суффикс не
+ * передаются. Смещения считаются в байтах UTF-8 и не разрезают суррогатные
+ * пары, поэтому попадают на границы символов. null — текст не изменился.
+ */
+export const textPatch = (before: string, after: string): TextPatch | null => {
+  if (before === after) return null;
+  let prefix = 0;
+  const maxPrefix = Math.min(before.length, after.length);
+  while (prefix < maxPrefix && before.charCodeAt(prefix) === after.charCodeAt(prefix)) prefix++;
+  if (prefix > 0 && isHighSurrogate(before.charCodeAt(prefix - 1))) prefix--;
+
+  let suffix = 0;
+  const maxSuffix = maxPrefix - prefix;
+  while (
+    suffix < maxSuffix &&
+    before.charCodeAt(before.length - 1 - suffix) === after.charCodeAt(after.length - 1 - suffix)
+  ) suffix++;
+  if (suffix > 0 && isHighSurrogate(before.charCodeAt(before.length - suffix - 1))) suffix--;
+
+  return {
+    offset: utf8Length(before.slice(0, prefix)),
+    length: utf8Length(before.slice(prefix, before.length - suffix)),
+    replacement: after.slice(prefix, after.length - suffix),
+  };
+};
+
 export const api = {
   register: async (username: string, password: string) => {
     try {
@@ -89,9 +124,12 @@ export const api = {
         handleNetworkError(error);
     }
   },
-  getMessages: async (token: string): Promise<ApiMessage[]> => {
+  // Одна страница диалога с peer, от новых к старым; before — cursor самого старого из уже загруженных
+  getMessages: async (token: string, peer: string, before?: string): Promise<ApiMessage[]> => {
     try {
-        const response = await fetch(`${API_URL}/messages`, {
+        const params = new URLSearchParams({ peer, limit: String(MESSAGES_PAGE_SIZE) });
+        if (before) params.set('before', before);
+        const response = await fetch(`${API_URL}/messages?${params}`, {
             method: 'GET',
             headers: { 
                 'Authorization': `Bearer ${token}`,
@@ -401,7 +439,7 @@ export const api = {
    * Note: The server enforces a file size limit of 50MB for the new content.
    * A 400 Bad Request will be returned if the new content exceeds this limit.
    */
-  updateTextFile: async (token: string, userId: string, fileId: string, content: string, filename: string): Promise<{ new_file_id: string }> => {
+  updateTextFile: async (token: string, userId: string, fileId: string, content: string, filename: string): Promise<{ new_file_id: string; version: number }> => {
     try {
       const file = new File([content], filename, { type: 'text/plain' });
       const formData = new FormData();
@@ -423,6 +461,32 @@ export const api = {
       handleNetworkError(error);
     }
   },
+  /**
+   * Sends only the changed fragments of a text document.
+   * Throws DOCUMENT_CONFLICT if the document changed since baseVersion.
+   */
+  patchTextFile: async (token: string, userId: string, fileId: string, baseVersion: number, patches: TextPatch[]): Promise<{ file_id: string; version: number }> => {
+    try {
+      const response = await fetch(`${API_URL}/text/${fileId}?user_id=${encodeURIComponent(userId)}`, {
+        method: 'PATCH',
+        headers: {
+          'Content-Type': 'application/json',
+          Authorization: `Bearer ${token}`,
+          'bypass-tunnel-reminder': 'true'
+        },
+        body: JSON.stringify({ base_version: baseVersion, patches }),
+      });
+      if (response.status === 409) {
+        throw new Error(DOCUMENT_CONFLICT);
+      }
+      if (!response.ok) {
+        await handleResponseError(response, 'Не удалось сохранить изменения.');
+      }
+      return response.json();
+    } catch (error) {
+      handleNetworkError(error);
+    }
+  },
   getFiles: async (token: string, userId: string): Promise<ApiFile[]> => {
     try {
       const response = await fetch(`${API_URL}/files?user_id=${encodeURIComponent(userId)}`, {
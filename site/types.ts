@@ -14,6 +14,8 @@ export interface Message {
 }
 
 export interface ApiMessage {
+  id?: string;
+  cursor?: string;
   sender: string;
   receiver: string;
   content: string | null;
@@ -29,6 +31,14 @@ export interface ApiFile {
   file_id: string;
   filename: string;
   content_type: string;
+  version?: number; // есть у редактируемых текстовых документов
+}
+
+// Правка текстового документа: смещения в байтах UTF-8, на границах символов
+export interface TextPatch {
+  offset: number;
+  length: number;
+  replacement: string;
 }
 
 export interface Contact {
@@ -47,6 +57,7 @@ export interface ApiGroup {
     name: string;
     admin: string;
     invite_key: string;
+    member_count: number;
 }
 
 export interface UserFile {
@@ -55,6 +66,7 @@ export interface UserFile {
   contentType: string;
   content?: string;
   url?: string;
+  version?: number;
 }
 
 export interface CalendarEvent {
@@ -0,0 +1,15 @@
+import asyncio
+import models
+from broker import LocalBroker, new_event
+
+def test_invalidate_user_drops_auth_and_avatar_caches():
+    models._user_cache.set("alice", {"username": "alice", "avatar_id": "old"})
+    models._avatar_cache.set("alice", {"username": "alice", "avatar_id": "old"})
+    asyncio.run(LocalBroker().invalidate_user("alice"))
+    assert models._user_cache.get("alice") is None
+    assert models._avatar_cache.get("alice") is None
+
+def test_invalidation_event_names_cache_and_key():
+    event = new_event("origin", [], None, invalidate=["user", "alice"])
+    assert event["invalidate"] == ["user", "alice"]
+    assert "invalidate" not in new_event("origin", ["bob"], "{}")
@@ -0,0 +1,213 @@
+# Случайные правки документа в cas_chunks против эталонных байтов в памяти.
+# Коллекции подменены простыми фейками, MongoDB не нужен.
+import asyncio
+import random
+import pytest
+from fastapi import HTTPException
+import chunkstore
+
+MAX_SIZE = 50 * 1024 * 1024
+
+class Result:
+    def __init__(self, matched_count: int):
+        self.matched_count = matched_count
+
+class FakeChunks:
+    def __init__(self):
+        self.docs = {}
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            query, update = op._filter, op._doc
+            doc = self.docs.get(query["_id"])
+            if doc is None:
+                if not op._upsert:
+                    continue
+                doc = self.docs[query["_id"]] = {"_id": query["_id"], "refs": 0, **update.get("$setOnInsert", {})}
+            doc["refs"] += update["$inc"]["refs"]
+
+    async def delete_many(self, query):
+        for digest in query["_id"]["$in"]:
+            if self.docs.get(digest, {}).get("refs", 1) <= 0:
+                del self.docs[digest]
+
+    async def find_one(self, query, projection=None):
+        return self.docs.get(query["_id"])
+
+    def find(self, query, projection=None):
+        async def found():
+            for digest in query["_id"]["$in"]:
+                if digest in self.docs:
+                    yield self.docs[digest]
+        return found()
+
+class FakeFiles:
+    def __init__(self):
+        self.docs = {}
+
+    async def insert_one(self, doc):
+        self.docs[doc["_id"]] = doc
+
+    async def update_one(self, query, update):
+        doc = self.docs.get(query["_id"])
+        if doc is None or doc.get("version") != query["version"]:
+            return Result(0)
+        doc.update(update["$set"])
+        doc["version"] += 1
+        return Result(1)
+
+    async def find_one_and_delete(self, query, projection=None):
+        return self.docs.pop(query["_id"], None)
+
+@pytest.fixture
+def store(monkeypatch):
+    chunks, files = FakeChunks(), FakeFiles()
+
+    async def no_quota(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(chunkstore, "chunks_collection", chunks)
+    monkeypatch.setattr(chunkstore, "files_collection", files)
+    monkeypatch.setattr(chunkstore, "charge_usage", no_quota)
+    monkeypatch.setattr(chunkstore, "release_usage", no_quota)
+    monkeypatch.setattr(chunkstore, "CAS_CHUNK_SIZE", 64)
+    monkeypatch.setattr(chunkstore, "CAS_CHUNK_MIN", 16)
+    return chunks, files
+
+async def pieces(data: bytes, step: int):
+    for i in range(0, len(data), step):
+        yield data[i:i + step]
+
+async def read_all(doc: dict) -> bytes:
+    reader = chunkstore.ChunkedFileReader(doc)
+    out = b""
+    while True:
+        piece = await reader.read()
+        if not piece:
+            return out
+        out += piece
+
+def random_bytes(rng: random.Random, n: int) -> bytes:
+    return bytes(rng.randrange(97, 123) for _ in range(n))
+
+def assert_refs(chunks: FakeChunks, files: FakeFiles):
+    # Счётчик ссылок каждого куска = число его вхождений во все манифесты
+    expected = {}
+    for doc in files.docs.values():
+        for digest, _ in doc["chunks"]:
+            expected[digest] = expected.get(digest, 0) + 1
+    assert {digest: doc["refs"] for digest, doc in chunks.docs.items()} == expected
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_patches_match_reference(store, seed):
+    chunks, files = store
+    rng = random.Random(seed)
+
+    async def scenario():
+        documents = {}
+        for _ in range(3):
+            data = random_bytes(rng, rng.randrange(0, 600))
+            file_id = await chunkstore.store_stream(pieces(data, rng.randrange(1, 100)), "doc.txt", {"user_id": "u"}, 0)
+            documents[file_id] = data
+        assert_refs(chunks, files)
+
+        for _ in range(40):
+            file_id = rng.choice(list(documents))
+            data = documents[file_id]
+            patches = []
+            for _ in range(rng.randrange(1, 4)):
+                offset = rng.randrange(0, len(data) + 1)
+                cut = rng.randrange(0, min(len(data) - offset, 200) + 1)
+                replacement = random_bytes(rng, rng.choice([0, 1, 5, 70, 200]))
+                patches.append((offset, cut, replacement))
+                data = data[:offset] + replacement + data[offset + cut:]
+            await chunkstore.patch_file(dict(files.docs[file_id]), patches, MAX_SIZE)
+            documents[file_id] = data
+
+            doc = files.docs[file_id]
+            assert doc["length"] == len(data)
+            assert await read_all(doc) == data
+            assert_refs(chunks, files)
+            # Правки не дробят документ: мелким может остаться только один кусок
+            # (хвост исходной загрузки или весь документ, если он сам мелкий)
+            small = [size for _, size in doc["chunks"] if size < chunkstore.CAS_CHUNK_MIN]
+            assert len(small) <= 1
+
+        for file_id in list(documents):
+            await chunkstore.delete_file(file_id)
+        assert chunks.docs == {}
+
+    asyncio.run(scenario())
+
+def test_identical_chunks_are_shared(store):
+    chunks, files = store
+
+    async def scenario():
+        data = bytes(range(64)) * 4
+        first = await chunkstore.store_stream(pieces(data, 10), "a", {"user_id": "u"})
+        second = await chunkstore.store_stream(pieces(data, 33), "b", {"user_id": "u"})
+        assert len(chunks.docs) == 1
+        assert_refs(chunks, files)
+        await chunkstore.delete_file(first)
+        assert_refs(chunks, files)
+        await chunkstore.delete_file(second)
+        assert chunks.docs == {}
+
+    asyncio.run(scenario())
+
+def test_stale_patch_conflicts_and_keeps_refs(store):
+    chunks, files = store
+
+    async def scenario():
+        file_id = await chunkstore.store_stream(pieces(b"hello world", 4), "a", {"user_id": "u"}, 0)
+        stale = dict(files.docs[file_id])
+        await chunkstore.patch_file(dict(stale), [(5, 0, b"!")], MAX_SIZE)
+        with pytest.raises(HTTPException) as error:
+            await chunkstore.patch_file(stale, [(0, 0, b"x")], MAX_SIZE)
+        assert error.value.status_code == 409
+        assert await read_all(files.docs[file_id]) == b"hello! world"
+        assert_refs(chunks, files)
+
+    asyncio.run(scenario())
+
+def test_reader_ends_when_chunk_was_released(store):
+    chunks, files = store
+
+    async def scenario():
+        data = random_bytes(random.Random(0), 300)
+        file_id = await chunkstore.store_stream(pieces(data, 64), "a", {"user_id": "u"}, 0)
+        reader = chunkstore.ChunkedFileReader(dict(files.docs[file_id]))
+        first = await reader.read()
+        # Параллельная правка переписала весь документ и отпустила старые куски
+        await chunkstore.replace_file(dict(files.docs[file_id]), pieces(b"new", 3), "a")
+        assert first == data[:64]
+        assert await reader.read() == b""
+        assert await reader.read() == b""
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("offset,cut", [(1, 0), (0, 1), (2, 1), (3, 1)])
+def test_patch_inside_code_point_is_rejected(store, offset, cut):
+    chunks, files = store
+
+    async def scenario():
+        # "жж" — по два байта на символ
+        file_id = await chunkstore.store_stream(pieces("жж".encode(), 4), "a", {"user_id": "u"}, 0)
+        with pytest.raises(HTTPException) as error:
+            await chunkstore.patch_file(dict(files.docs[file_id]), [(offset, cut, b"x")], MAX_SIZE)
+        assert error.value.status_code == 400
+        assert await read_all(files.docs[file_id]) == "жж".encode()
+
+    asyncio.run(scenario())
+
+def test_patch_on_code_point_boundaries(store):
+    chunks, files = store
+
+    async def scenario():
+        text = "привет, мир " * 20
+        file_id = await chunkstore.store_stream(pieces(text.encode(), 50), "a", {"user_id": "u"}, 0)
+        start = len("привет, ".encode())
+        await chunkstore.patch_file(dict(files.docs[file_id]), [(start, len("мир".encode()), "свет".encode())], MAX_SIZE)
+        assert (await read_all(files.docs[file_id])).decode() == "привет, свет " + "привет, мир " * 19
+
+    asyncio.run(scenario())
@@ -0,0 +1,26 @@
+import asyncio
+from connections import add_connection, is_online
+
+class BrokenSocket:
+    def __init__(self):
+        self.closed_with = None
+
+    async def send_text(self, text):
+        raise RuntimeError("connection reset")
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+def test_failed_send_closes_socket():
+    async def scenario():
+        socket = BrokenSocket()
+        conn = add_connection("alice", socket)
+        conn.enqueue("hello")
+        for _ in range(5):
+            await asyncio.sleep(0)
+        return socket, conn
+
+    socket, conn = asyncio.run(scenario())
+    assert conn.closed
+    assert not is_online("alice")
+    assert socket.closed_with == 1011
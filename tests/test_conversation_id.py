@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+from pymongo.errors import DuplicateKeyError
+import models
+from models import conversation_id, search_scope
+
+def test_order_independent():
+    assert conversation_id("alice", "bob") == conversation_id("bob", "alice")
+
+def test_colon_in_username_does_not_collide():
+    assert conversation_id("a:b", "c") != conversation_id("a", "b:c")
+    assert search_scope("a:b", "c") != search_scope("a", "b:c")
+
+def test_non_ascii_length_in_characters():
+    assert conversation_id("ёж", "яблоко") == "6:яблоко:ёж"  # ё (U+0451) сортируется после я (U+044F)
+
+class FakeLocks:
+    def __init__(self, doc=None):
+        self.doc = doc
+
+    async def find_one(self, query, projection=None):
+        return self.doc
+
+    async def update_one(self, query, update, upsert=False):
+        if self.doc is not None and "until" in query:
+            raise DuplicateKeyError("lease is held")
+        self.doc = {**(self.doc or {}), **update["$set"]}
+
+def test_legacy_rows_are_read_until_migrated(monkeypatch):
+    monkeypatch.setattr(models, "conversation_ids_migrated", False)
+    legacy = models._conversation_filter("alice", "bob")["$or"][1]
+    assert legacy["conversation_id"] == {"$exists": False}
+    assert {"sender": "bob", "receiver": "alice"} in legacy["$or"]
+
+    monkeypatch.setattr(models, "conversation_ids_migrated", True)
+    assert models._conversation_filter("alice", "bob") == {"conversation_id": conversation_id("alice", "bob")}
+
+def test_startup_migration_runs_once(monkeypatch):
+    locks = FakeLocks()
+    runs = []
+
+    async def migrate():
+        runs.append(1)
+        await locks.update_one({"_id": "migrate_conversation_ids"}, {"$set": {"done": True}})
+        models.conversation_ids_migrated = True
+        return 0
+
+    monkeypatch.setattr(models, "db", SimpleNamespace(locks=locks))
+    monkeypatch.setattr(models, "migrate_conversation_ids", migrate)
+    monkeypatch.setattr(models, "conversation_ids_migrated", False)
+    asyncio.run(models.migrate_conversation_ids_at_startup())
+    assert runs == [1] and models.conversation_ids_migrated
+
+    # Следующий воркер видит отметку и не сканирует коллекцию заново
+    monkeypatch.setattr(models, "conversation_ids_migrated", False)
+    asyncio.run(models.migrate_conversation_ids_at_startup())
+    assert runs == [1] and models.conversation_ids_migrated
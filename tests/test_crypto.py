@@ -0,0 +1,15 @@
+import crypto
+
+def test_full_history_page_leaves_event_loop():
+    # MESSAGES_PAGE_MAX = 200 коротких сообщений
+    page = crypto.encrypt_many(["привет"] * 200)
+    assert crypto._offload(page)
+
+def test_few_long_messages_leave_event_loop():
+    page = crypto.encrypt_many(["x" * crypto.BATCH_THREAD_BYTES])
+    assert crypto._offload(page)
+
+def test_small_batch_stays_inline():
+    page = crypto.encrypt_many(["привет", None, "пока"])
+    assert not crypto._offload(page)
+    assert crypto.decrypt_many(page) == ["привет", None, "пока"]
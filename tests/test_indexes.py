@@ -0,0 +1,70 @@
+# Проверка планов горячих запросов: ни один не должен сканировать коллекцию целиком.
+# Нужен запущенный MongoDB (docker-compose up); адрес берётся из REDFAX_TEST_MONGO_URI.
+import asyncio
+import os
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
+import models
+
+MONGO_URI = os.getenv("REDFAX_TEST_MONGO_URI", models.MONGO_URI)
+TEST_DB = "redfax_test_indexes"
+
+@pytest.fixture(scope="module")
+def sync_db():
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("MongoDB недоступен")
+    client.drop_database(TEST_DB)
+
+    async def create():
+        motor_client = AsyncIOMotorClient(MONGO_URI)
+        original = models.db
+        models.db = motor_client[TEST_DB]
+        try:
+            await models.ensure_indexes()
+        finally:
+            models.db = original
+            motor_client.close()
+    asyncio.run(create())
+
+    yield client[TEST_DB]
+    client.drop_database(TEST_DB)
+    client.close()
+
+def stages(plan: dict):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from stages(child)
+
+HOT_QUERIES = [
+    ("messages", {"conversation_id": models.conversation_id("alice", "bob")}, [("timestamp", -1), ("_id", -1)]),
+    ("messages", {"$or": [{"sender": "alice"}, {"receiver": "alice"}]}, [("timestamp", -1), ("_id", -1)]),
+    ("messages", {"sender": "alice", "client_id": "c1"}, None),
+    ("group_messages", {"group_id": "g1"}, [("timestamp", 1)]),
+    ("groups", {"members": "alice"}, None),
+    ("groups", {"invite_key": "abc"}, None),
+    ("users", {"username": "alice"}, None),
+    ("friends", {"user": "alice"}, None),
+    ("search_index", {"s": models.search_scope("alice", "bob"), "t": b"x" * 16}, [("ts", -1), ("m", -1)]),
+    ("sync_state", {"username": "alice"}, None),
+    ("tasks", {"username": "alice"}, None),
+    ("fs.files", {"metadata.user_id": "alice"}, None),
+    ("voice_fs.files", {"metadata.user_id": "alice"}, None),
+    ("avatars.files", {"metadata.user_id": "alice"}, None),
+    ("cas_chunks", {"refs": {"$lte": 0}}, None),
+]
+
+@pytest.mark.parametrize("collection,query,sort", HOT_QUERIES)
+def test_hot_query_uses_index(sync_db, collection, query, sort):
+    cursor = sync_db[collection].find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    plan = cursor.explain()["queryPlanner"]["winningPlan"]
+    assert "COLLSCAN" not in set(stages(plan)), plan
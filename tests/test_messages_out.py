@@ -0,0 +1,48 @@
+# Страница истории с вложениями: имена файлов должны приходить одним запросом
+# к fs.files, а не по запросу на сообщение.
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+import pytest
+from bson import ObjectId
+import models
+from crypto import encrypt_many
+from main import messages_out
+
+class CountingFiles:
+    def __init__(self, docs: dict):
+        self.docs = docs
+        self.finds = 0
+
+    def find(self, query, projection=None):
+        self.finds += 1
+
+        async def found():
+            for oid in query["_id"]["$in"]:
+                if oid in self.docs:
+                    yield {"_id": oid, "filename": self.docs[oid]}
+        return found()
+
+    async def find_one(self, *args, **kwargs):
+        raise AssertionError("find_one на каждое сообщение")
+
+@pytest.mark.parametrize("attachments", [1, 10, 200])
+def test_page_with_attachments_reads_filenames_once(monkeypatch, attachments):
+    file_ids = [ObjectId() for _ in range(attachments)]
+    files = CountingFiles({oid: f"file{i}.txt" for i, oid in enumerate(file_ids)})
+    monkeypatch.setattr(models, "db", SimpleNamespace(fs=SimpleNamespace(files=files)))
+
+    contents = encrypt_many(["текст"] * attachments)
+    raw = [
+        {"_id": ObjectId(), "sender": "alice", "receiver": "bob", "file_id": str(oid),
+         "content": content, "timestamp": datetime(2024, 1, 1)}
+        for oid, content in zip(file_ids, contents)
+    ]
+    # Сообщение со старым именем в документе в запрос не попадает
+    raw.append({"_id": ObjectId(), "sender": "bob", "receiver": "alice", "file_id": str(ObjectId()),
+                "filename": "saved.txt", "timestamp": datetime(2024, 1, 1)})
+
+    shaped = asyncio.run(messages_out(raw))
+    assert files.finds == 1
+    assert [m["filename"] for m in shaped] == [f"file{i}.txt" for i in range(attachments)] + ["saved.txt"]
+    assert shaped[0]["content"] == "текст"
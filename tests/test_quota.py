@@ -0,0 +1,58 @@
+# Предварительная проверка квоты: владелец, уже упёршийся в лимит, получает
+# отказ до того, как тело загрузки начнёт писаться в хранилище.
+import asyncio
+from types import SimpleNamespace
+import pytest
+from fastapi import HTTPException
+import main
+import quota
+
+class FakeUsage:
+    def __init__(self, doc=None):
+        self.doc = doc
+
+    async def find_one(self, query, projection=None):
+        return self.doc
+
+class UnreadUpload:
+    filename = "a.txt"
+
+    def __init__(self, size=None):
+        self.size = size
+
+    async def read(self, n=-1):
+        raise AssertionError("тело загрузки прочитано до проверки квоты")
+
+@pytest.fixture
+def usage(monkeypatch):
+    collection = FakeUsage()
+    monkeypatch.setattr(quota, "usage_collection", collection)
+    return collection
+
+def rejected(bucket, file) -> bool:
+    async def scenario():
+        await main.save_upload(bucket, file, {"user_id": "u"})
+    try:
+        asyncio.run(scenario())
+    except HTTPException as e:
+        assert e.status_code == 400
+        return True
+    return False
+
+def test_full_byte_quota_rejects_before_streaming(usage):
+    usage.doc = {"bytes": quota.QUOTA_MAX_BYTES, "counts": {"voice_fs": 3}}
+    assert rejected(main.fs_bucket, UnreadUpload())
+    assert rejected(main.voice_fs_bucket, UnreadUpload())
+
+def test_known_size_over_quota_rejects_before_streaming(usage):
+    usage.doc = {"bytes": quota.QUOTA_MAX_BYTES - 10, "counts": {}}
+    assert rejected(main.voice_fs_bucket, UnreadUpload(size=11))
+
+def test_file_count_limit_applies_to_fs_only(monkeypatch):
+    collection = FakeUsage({"bytes": 0, "counts": {"fs": quota.QUOTA_MAX_FILES}})
+    monkeypatch.setattr(quota, "usage_collection", collection)
+
+    with pytest.raises(HTTPException):
+        asyncio.run(quota.check_usage("u", "fs", 1))
+    asyncio.run(quota.check_usage("u", "voice_fs", 1))
+    asyncio.run(quota.check_usage("u", "fs", 1, files=0))
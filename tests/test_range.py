@@ -0,0 +1,26 @@
+import pytest
+from fastapi import HTTPException
+from main import parse_range
+
+@pytest.mark.parametrize("header,length,expected", [
+    (None, 10, None),
+    ("bytes=0-", 10, (0, 9)),
+    ("bytes=2-4", 10, (2, 4)),
+    ("bytes=5-100", 10, (5, 9)),
+    ("bytes=-3", 10, (7, 9)),
+    ("bytes=-30", 10, (0, 9)),
+    ("bytes=0-", 0, None),  # пустой файл — целиком, а не 416
+    ("bytes=5-2", 10, None),  # перевёрнутый диапазон игнорируется
+    ("bytes=abc", 10, None),
+    ("bytes=-", 10, None),
+    ("bytes=1-2,4-5", 10, None),
+    ("items=0-1", 10, None),
+])
+def test_parse_range(header, length, expected):
+    assert parse_range(header, length) == expected
+
+@pytest.mark.parametrize("header", ["bytes=10-", "bytes=20-30", "bytes=-0"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(HTTPException) as e:
+        parse_range(header, 10)
+    assert e.value.status_code == 416
@@ -0,0 +1,44 @@
+# Эндпоинты отдают готовые словари, поэтому их ключи должны совпадать с полями
+# response_model — иначе лишние поля молча отбросятся, а недостающие дадут 500.
+from datetime import date, datetime
+import json
+from bson import Binary, ObjectId
+from main import json_response, message_out
+from models import group_info, task_out
+from schemas import GroupInfo, MessageOut, TaskOut
+
+def assert_shape(shaped: dict, model):
+    assert set(shaped) == set(model.model_fields)
+    model.model_validate(shaped)
+
+def test_message_out_matches_schema():
+    msg = {
+        "_id": ObjectId(),
+        "sender": "alice",
+        "receiver": "bob",
+        "file_id": ObjectId(),
+        "filename": "a.txt",
+        "voice": {"duration": 1.5, "waveform": Binary(bytes(64))},
+        "timestamp": datetime(2024, 1, 1),
+    }
+    assert_shape(message_out(msg, {}, "привет"), MessageOut)
+
+def test_group_message_out_matches_schema():
+    msg = {"_id": ObjectId(), "sender": "alice", "group_id": "g1", "timestamp": datetime(2024, 1, 1)}
+    assert_shape(message_out(msg, {}, None), MessageOut)
+
+def test_task_out_matches_schema():
+    doc = {"_id": ObjectId(), "title": "купить хлеб", "date": date(2024, 1, 1).isoformat()}
+    assert_shape(task_out(doc), TaskOut)
+
+def test_group_info_matches_schema():
+    doc = {"_id": ObjectId(), "name": "семья", "admin": "alice", "invite_key": "k", "member_count": 2}
+    assert_shape(group_info(doc), GroupInfo)
+
+def test_direct_json_matches_response_model_json():
+    # json_response пропускает response_model — вывод должен совпадать с тем,
+    # что FastAPI получил бы через модель
+    msg = {"_id": ObjectId(), "sender": "alice", "receiver": "bob", "timestamp": datetime(2024, 1, 1, 12, 30, 0, 123000)}
+    shaped = message_out(msg, {}, "привет")
+    via_model = MessageOut.model_validate(shaped).model_dump_json()
+    assert json.loads(json_response([shaped]).body) == [json.loads(via_model)]
@@ -0,0 +1,22 @@
+from array import array
+import sys
+import pytest
+from media import WAVEFORM_POINTS, waveform
+
+def pcm(samples: list) -> bytes:
+    data = array("h", samples)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+@pytest.mark.parametrize("n", [0, 1, 10, 63, 64, 65, 100, 127, 129, 8000 * 3 + 7])
+def test_always_waveform_points(n):
+    _, peaks = waveform(pcm([1000] * n), 8000, 1)
+    assert len(peaks) == WAVEFORM_POINTS
+
+def test_peaks_follow_amplitude():
+    # Первая половина тихая, вторая на пределе
+    duration, peaks = waveform(pcm([0] * 100 + [-32768] * 100), 100, 1)
+    assert duration == 2
+    assert peaks[:WAVEFORM_POINTS // 2] == bytes(WAVEFORM_POINTS // 2)
+    assert set(peaks[WAVEFORM_POINTS // 2:]) == {255}
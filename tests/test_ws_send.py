@@ -0,0 +1,98 @@
+# Отправка сообщений по WebSocket: ack, идемпотентный повтор и битые кадры.
+# Коллекции подменены фейками, MongoDB не нужен.
+import asyncio
+import json
+from types import SimpleNamespace
+import pytest
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+import models
+from connections import add_connection
+from main import handle_ws_send
+
+class FakeMessages:
+    def __init__(self):
+        self.docs = []
+
+    async def insert_one(self, doc):
+        if doc.get("client_id") and any(
+            d["sender"] == doc["sender"] and d.get("client_id") == doc["client_id"] for d in self.docs
+        ):
+            raise DuplicateKeyError("sender_client_id")
+        doc["_id"] = ObjectId()
+        self.docs.append(doc)
+
+    async def find_one(self, query):
+        for doc in self.docs:
+            if all(doc.get(key) == value for key, value in query.items()):
+                return doc
+        return None
+
+class FakeSearchIndex:
+    async def insert_many(self, docs, ordered=True):
+        pass
+
+class Sender:
+    # Вместо Connection: кадры, отправленные обратно отправителю
+    def __init__(self, username: str):
+        self.username = username
+        self.frames = []
+
+    def enqueue(self, text: str):
+        self.frames.append(json.loads(text))
+
+class RecordingSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+    async def close(self, code=1000):
+        pass
+
+@pytest.fixture
+def messages(monkeypatch):
+    messages = FakeMessages()
+    monkeypatch.setattr(models, "db", SimpleNamespace(messages=messages, search_index=FakeSearchIndex()))
+    return messages
+
+def run_frames(frames: list):
+    sender = Sender("alice")
+    bob = RecordingSocket()
+
+    async def scenario():
+        conn = add_connection("bob", bob)
+        for frame in frames:
+            await handle_ws_send(sender, frame)
+        await asyncio.sleep(0.01)
+        conn.close()
+
+    asyncio.run(scenario())
+    return sender.frames, bob.frames
+
+def test_send_acks_and_pushes(messages):
+    acks, pushed = run_frames([{"type": "send_message", "receiver": "bob", "content": "привет", "client_id": "c1"}])
+    assert acks[0]["type"] == "ack"
+    assert acks[0]["client_id"] == "c1"
+    assert acks[0]["id"] == str(messages.docs[0]["_id"])
+    assert [frame["data"]["content"] for frame in pushed] == ["привет"]
+
+def test_retry_with_same_client_id_is_idempotent(messages):
+    frame = {"type": "send_message", "receiver": "bob", "content": "привет", "client_id": "c1"}
+    acks, pushed = run_frames([frame, dict(frame)])
+    assert len(messages.docs) == 1
+    assert [ack["type"] for ack in acks] == ["ack", "ack"]
+    assert acks[0]["id"] == acks[1]["id"]
+    assert len(pushed) == 1  # повтор получателю не пушится
+
+@pytest.mark.parametrize("frame", [
+    {"type": "send_message", "content": "без получателя", "client_id": "c2"},
+    {"type": "send_message", "receiver": "bob", "client_id": "c2"},
+    {"type": "send_message", "receiver": "bob", "content": 42, "client_id": "c2"},
+])
+def test_malformed_frame_gets_error(messages, frame):
+    replies, pushed = run_frames([frame])
+    assert replies == [{"type": "error", "client_id": "c2", "detail": "Неверный формат сообщения"}]
+    assert messages.docs == []
+    assert pushed == []